@@ -5,6 +5,7 @@ Grabs relevant USGS/NOAA data based on information in settings.py
 import pandas as pd
 import os
 from .settings import *
+from .tools import GenerateForcing
 import noaa_coops as nc
 from nwis import Nwis
 nwis_data = Nwis()
@@ -67,3 +68,5 @@ NOAA_Wind = NOAA_Wind[['spd','dir']].rename(
     columns={'spd':'Speed','dir':'Direction'})
 NOAA_Wind.to_csv(name_Wind, index_label='datetime') # Save
 
+# BUNDLE------------------------------------------------------------------------
+GenerateForcing() # Compile the series into one binary file for the run
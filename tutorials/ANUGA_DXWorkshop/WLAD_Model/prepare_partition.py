@@ -0,0 +1,33 @@
+"""
+Prepare partitioned domain files for a parallel ANUGA simulation
+Builds the full domain once and writes one file per processor to
+partition_dir, loaded by run_parallel.py when use_partition_files is True.
+Assumes the other prepare_*.py scripts have been run. Rerun after any
+change to the mesh, topography or number of processors.
+Usage: python prepare_partition.py 384
+"""
+# ------------------------------------------------------------------------------
+# Import necessary modules
+# ------------------------------------------------------------------------------
+from __future__ import division, print_function
+import argparse
+from .settings import *
+from .tools import GenerateForcing, GenerateDomain, DumpPartitions, \
+                   GeneratePartitionWeights
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('numprocs', type=int,
+                    help='Number of processors of the parallel run')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+# CREATE DOMAIN-----------------------------------------------------------------
+fBC_tides = None if T_steady else GenerateForcing()['tides']
+domain = GenerateDomain(fBC_tides) # Mesh, elevation and cold start stage
+print(domain.statistics())
+
+# PARTITION---------------------------------------------------------------------
+weights = GeneratePartitionWeights(domain) # None unless partition_weighting is set
+DumpPartitions(domain, args.numprocs, partition_dir, weights=weights,
+               verbose=args.verbose)
+print('Wrote %d partitions to %s' % (args.numprocs, partition_dir))
@@ -8,7 +8,7 @@ Interpolates .ASCII raster onto unstructured mesh
 import numpy as np
 import anuga
 from .settings import topography_source, base_res
-from .tools import GenerateDomainGeometry
+from .tools import GenerateDomainGeometry, CreateDomainCached
 
 # FILE CONVERSIONS--------------------------------------------------------------
 # Note: If starting from GeoTIFF, need to convert to ASCII. Optional command below:
@@ -23,14 +23,12 @@ anuga.dem2pts(topography_source.replace('.asc','.dem'),
 # CREATE MESH-------------------------------------------------------------------
 bounding_polygon, boundary_tags, inside_regions, geo_reference = GenerateDomainGeometry()
 
-domain = anuga.create_domain_from_regions(bounding_polygon, boundary_tags,
-                                          maximum_triangle_area=base_res,
-                                          interior_regions=inside_regions,
-                                          poly_geo_reference=geo_reference,
-                                          mesh_geo_reference=geo_reference,
-                                          mesh_filename = 'WLAD2.msh')
+domain = CreateDomainCached(bounding_polygon, boundary_tags,
+                            inside_regions, geo_reference,
+                            maximum_triangle_area=base_res,
+                            mesh_filename = 'WLAD2.msh')
 
-print domain.statistics()
+print(domain.statistics())
 # Save list of cell areas
 np.savetxt('areas.csv', domain.areas, delimiter=",")
 
@@ -1,7 +1,8 @@
 """
 Code to run the ANUGA simulation in parallel on TACC. Settings loaded
 from settings.py. Assumes both prepare_*.py scripts have been run.
-Submit to slurm using parallel.job
+Submit to slurm using parallel.job. To continue a run stopped by the job
+time limit, set restart_dir to its run folder and submit again.
 """
 # ------------------------------------------------------------------------------
 # Import necessary modules
@@ -28,124 +29,136 @@ verbose = args.verbose
 # ------------------------------------------------------------------------------
 # Setup boundary conditions
 # ------------------------------------------------------------------------------
+# Gauge series, read from the binary bundle on processor 0 and sent to the others
+forcing = Broadcast(GenerateForcing() if myid == 0 else None)
+
 # TIDES-------------------------------------------------------------------------
 if not T_steady:
-    fBC_tides = GenerateTideGauge()
+    fBC_tides = forcing['tides']
     # fBC_tides = GenerateTideCosine()
 
 # WIND--------------------------------------------------------------------------
 if wind_on:
-    fBC_windspeed, fBC_winddir = GenerateWind()
+    fBC_windspeed, fBC_winddir = forcing['windspeed'], forcing['winddir']
 
 # DISCHARGE---------------------------------------------------------------------
-fQ_WLO = GenerateHydrograph(name_WLO) # Calumet inlet
-fQ_ATC = GenerateHydrograph(name_ATC) # Morgan City inlet
-fQ_FRA = GenerateHydrograph(name_FRA) # Franklin outlet
+fQ_WLO = forcing['Q_WLO'] # Calumet inlet
+fQ_ATC = forcing['Q_ATC'] # Morgan City inlet
+fQ_FRA = forcing['Q_FRA'] # Franklin outlet
 # Avoca outlet discharge constant and set by Q_AVO
 
-# INITIAL CONDITIONS------------------------------------------------------------
-if hot_start:
-    init_depth = np.loadtxt(IC_depth_source, delimiter=',')
-    init_xmom = np.loadtxt(IC_depth_source, delimiter=',')
-    init_ymom = np.loadtxt(IC_depth_source, delimiter=',')
-
 # ------------------------------------------------------------------------------
-# Do the domain creation on processor 0
+# Make working directory here so we don't repeat the process on each cpu
 # ------------------------------------------------------------------------------
-if myid == 0:
-    # ------------------------------------------------------------------------------
-    # Make working directory here so we don't repeat the process on each cpu
-    # ------------------------------------------------------------------------------
+restart = restart_dir is not None
+if restart:
+    mydir = restart_dir # Continue the interrupted run in its own folder
+elif myid == 0:
     mydir = os.path.join('/Outputs/', 
                          datetime.datetime.now().strftime('%y%m%d_%H%M_' + modelname))
     os.makedirs(mydir)
     os.makedirs(mydir + '/figs')
     os.makedirs(mydir + '/data')
+    os.makedirs(mydir + '/checkpoints')
+mydir = Broadcast(mydir if myid == 0 else None)
+checkpoint_dir = os.path.join(mydir, 'checkpoints')
 
+if restart:
+    # Latest time with a consistent checkpoint from every cpu
+    restart_time = Broadcast(LatestCheckpoint(checkpoint_dir, numprocs) if myid == 0 else None)
+    start_time = float(restart_time)
+else:
+    start_time = 0.
+# Hot start files are not needed when restarting from a checkpoint
+load_IC = hot_start and not restart
+
+if use_partition_files:
     # ------------------------------------------------------------------------------
-    # Create domain and mesh
+    # Each cpu loads its own part of the domain, written by prepare_partition.py
     # ------------------------------------------------------------------------------
-    bounding_polygon, boundary_tags, inside_regions, geo_reference = GenerateDomainGeometry()
-
-    domain = anuga.create_domain_from_regions(bounding_polygon, boundary_tags,
-                                              maximum_triangle_area=base_res,
-                                              interior_regions=inside_regions,
-                                              poly_geo_reference=geo_reference,
-                                              mesh_geo_reference=geo_reference,
-                                              mesh_filename = 'WLAD2.msh')
-    domain.set_name('WLAD2')
+    domain, FricClass = LoadPartition(partition_dir=partition_dir)
     domain.set_datadir(mydir)
-    domain.set_flow_algorithm('DE1')
-    domain.set_low_froude(1)  # Use low-froude DE1 to reduce flux damping
-    domain.set_minimum_allowed_height(0.005)  # Only store heights > 0.5 cm
+    if myid == 0:
+        print(domain.statistics())
+        if load_IC:
+            IC_info = CheckInitialConditions(PartitionFingerprint(partition_dir=partition_dir))
+            print('Source of IC files is %s' % IC_info['source_run'])
+
+else:
+    # ------------------------------------------------------------------------------
+    # Do the domain creation on processor 0
+    # ------------------------------------------------------------------------------
+    if myid == 0:
+        # Create domain and mesh, with elevation and cold start stage
+        domain = GenerateDomain(None if T_steady else fBC_tides)
+        domain.set_datadir(mydir)
+
+        # Plot mesh
+        fig = plt.figure(figsize=(10, 12), dpi=200, facecolor='w', edgecolor='k')
+        dplotter = animate.Domain_plotter(domain)
+        plt.triplot(dplotter.triang, linewidth=0.1);
+        plt.axis('scaled')
+        plt.savefig(mydir + '/mesh.png')
+        plt.close()
+
+        print(domain.statistics())
 
-    # Plot mesh
-    fig = plt.figure(figsize=(10, 12), dpi=200, facecolor='w', edgecolor='k')
-    dplotter = animate.Domain_plotter(domain)
-    plt.triplot(dplotter.triang, linewidth=0.1);
-    plt.axis('scaled')
-    plt.savefig(mydir + '/mesh.png')
-    plt.close()
+        if load_IC:
+            # Check the IC file was saved on this mesh, each cpu loads its own
+            # cells once the domain is distributed
+            IC_info = CheckInitialConditions(domain)
+            print('Source of IC files is %s' % IC_info['source_run'])
 
-    print(domain.statistics())
+        # Plot the centroid elevation of the mesh cells
+        msl = 0.3
+        fig = plt.figure(figsize=(10, 10), dpi=400, facecolor='w', edgecolor='k')
+        plt.tripcolor(dplotter.triang, facecolors=dplotter.elev,
+                      vmax=msl+5, vmin=msl-5, cmap='cmo.topo')
+        plt.colorbar();
+        plt.title("Elevation");
+        plt.axis('scaled')
+        plt.savefig(mydir + '/elev.png')
+        plt.close()
+
+    else:
+        domain = None
 
     # ------------------------------------------------------------------------------
-    # Set Inital Conditions
+    # Produce parallel domain
     # ------------------------------------------------------------------------------
-    # ---------------Load pre-established elevation----------------------
-    topo = np.loadtxt(topography_source.replace('.asc','.csv'), delimiter=",")
-
-    stage = topo.copy()  # Initialize stage as = topography
-    if hot_start:
-        print('Source of IC files is %s' % IC_source_run)
-        stage = topo + init_depth  # Add depth to topo
-        # stage[topo <= fBC_tides(0)] = fBC_tides(0)
-        # Initialize momentums if we have them:
-        domain.set_quantity('xmomentum', init_xmom, location='centroids')
-        domain.set_quantity('ymomentum', init_ymom, location='centroids')
-    elif not T_steady:
-        stage[topo <= fBC_tides(0)] = fBC_tides(0) # Used for cold start
-    else:
-        stage[topo <= steady_T_elev] = steady_T_elev
-    domain.set_quantity('elevation', topo, location='centroids') 
-    domain.set_quantity('stage', stage, location='centroids')  # Initialize depth
-
-    # Plot the centroid elevation of the mesh cells
-    msl = 0.3
-    fig = plt.figure(figsize=(10, 10), dpi=400, facecolor='w', edgecolor='k')
-    plt.tripcolor(dplotter.triang, facecolors=dplotter.elev,
-                  vmax=msl+5, vmin=msl-5, cmap='cmo.topo')
-    plt.colorbar();
-    plt.title("Elevation");
-    plt.axis('scaled')
-    plt.savefig(mydir + '/elev.png')
-    plt.close()
+    # Balance the wet area rather than the number of cells, if set
+    weights = GeneratePartitionWeights(domain) if myid == 0 else None
+    with WeightedPartitioning(weights):
+        domain = distribute(domain)
 
-else:
-    domain = None
+    # Class of each cell, interpolated from the friction raster onto the grid
+    x = domain.quantities['x'].centroid_values
+    y = domain.quantities['y'].centroid_values
+    FricClass = AssignFricClass(Raster2MeshCached(x, y, parallel=True))
 
-# ------------------------------------------------------------------------------
-# Produce parallel domain
-# ------------------------------------------------------------------------------
-domain = distribute(domain)
 domain.set_store_vertices_uniquely(False)
 
+if load_IC:
+    # Read only the cells on this cpu from the memory mapped IC file
+    init_depth, init_xmom, init_ymom = LoadInitialConditions(domain)
+    elev = domain.quantities['elevation'].centroid_values
+    domain.set_quantity('stage', elev + init_depth, location='centroids')
+    domain.set_quantity('xmomentum', init_xmom, location='centroids')
+    domain.set_quantity('ymomentum', init_ymom, location='centroids')
+
 #---------------------------------------------------------------------------
 # Assign Friction
 #---------------------------------------------------------------------------
-x = domain.quantities['x'].centroid_values
-y = domain.quantities['y'].centroid_values
-FricVal = Raster2Mesh(x, y) # Interpolate from raster onto grid
-n, m, hv, D = AssignFricValue(FricVal) # Assign to each cell
-
 # Assign Mannings
-domain.set_quantity('friction', n, location = 'centroids')
-# Assign Baptist
+domain.set_quantity('friction', np.array(n_array)[FricClass], location = 'centroids')
+# Assign Baptist, per class parameters looked up from the cell classes
 bapt_op = Baptist_operator(domain,
-                           veg_diameter=D,
-                           veg_density=m,
-                           veg_height=hv,
-                           use_diffusivity=False)
+                           veg_diameter=D_array,
+                           veg_density=m_array,
+                           veg_height=h_array,
+                           veg_class=FricClass,
+                           use_diffusivity=False,
+                           scheme=veg_drag_scheme)
 
 # ------------------------------------------------------------------------------
 # Apply forcings
@@ -159,21 +172,48 @@ Br = anuga.Reflective_boundary(domain)  # Solid walls
 domain.set_boundary({'bay': Bout, 'sides': Br})
 
 if wind_on:
-    W = anuga.Wind_stress(fBC_windspeed(0), fBC_winddir(0))
+    # Centred in the first yieldstep when restarting, as updated in evolve below
+    t_wind = start_time + timestep/2 if restart else 0
+    W = anuga.Wind_stress(fBC_windspeed(t_wind), fBC_winddir(t_wind))
     domain.forcing_terms.append(W) # Apply wind
 
 # Setup inlets
-inlet_WLO = Inlet_operator(domain, Q_WLO_loc, Q = fQ_WLO(0))
-inlet_ATC = Inlet_operator(domain, Q_ATC_loc, Q = fQ_ATC(0))
-outlet_FRA = Inlet_operator(domain, Q_FRA_loc, Q = fQ_FRA(0))
+inlet_WLO = Inlet_operator(domain, Q_WLO_loc, Q = fQ_WLO(start_time))
+inlet_ATC = Inlet_operator(domain, Q_ATC_loc, Q = fQ_ATC(start_time))
+outlet_FRA = Inlet_operator(domain, Q_FRA_loc, Q = fQ_FRA(start_time))
 outlet_AVO = Inlet_operator(domain, Q_AVO_loc, Q = Q_AVO)
 
+# Apply the slowly varying drag at a reduced frequency, if set. The inlets
+# stay on every timestep, see settings.py
+if operator_interval is not None:
+    domain.set_fractional_step_operator_interval(bapt_op, interval=operator_interval)
+
+# ------------------------------------------------------------------------------
+# Checkpointing, and restart from the latest checkpoint
+# ------------------------------------------------------------------------------
+if checkpoint_on:
+    domain.set_checkpointing(checkpoint_dir=checkpoint_dir,
+                             checkpoint_step=checkpoint_step,
+                             checkpoint_time=checkpoint_walltime)
+
+if restart:
+    # Flow, integrals, volume history and operator state of this cpu
+    domain.load_checkpoint(CheckpointFile(checkpoint_dir, domain.get_name(),
+                                          restart_time))
+    # Drop output stored after the checkpoint, then add to the sww file
+    TrimSWW(os.path.join(mydir, domain.get_name() + '.sww'),
+            domain.get_relative_time())
+    domain.initialise_storage(append=True)
+    if myid == 0:
+        print('Restarting from checkpoint at time %s' % restart_time)
+
 # ------------------------------------------------------------------------------
 # Evolve system through time
 # ------------------------------------------------------------------------------
 barrier()
-# Evolve the domain
-for n, t in enumerate(domain.evolve(yieldstep=timestep, finaltime=finaltime)):
+# Evolve the domain, without repeating the checkpoint time on a restart
+for n, t in enumerate(domain.evolve(yieldstep=timestep, finaltime=finaltime,
+                                    skip_initial_step=restart)):
     if myid == 0:
         domain.print_timestepping_statistics()
     
@@ -202,19 +242,19 @@ for n, t in enumerate(domain.evolve(yieldstep=timestep, finaltime=finaltime)):
 barrier()
 
 # ---------------------------------------------------------------
-# Finalize
+# Merge outputs
 # ---------------------------------------------------------------
 domain.sww_merge(delete_old=True)
-finalize()
 
 # ------------------------------------------------------------------------------
-# Save a couple extra outputs on processor 0
+# Save a couple extra outputs, with the timesteps split across processors
 # ------------------------------------------------------------------------------
-if myid == 0:
-    swwvals = anuga.utilities.plot_utils.get_centroids(os.path.join(mydir,'WLAD2.sww'),
-                                                       timeSlices = 'all')
-    # Query values: time, x, y, stage, elev, height, xmom, ymom, xvel, yvel, friction, vel, etc
-    SaveOutputs(swwvals, mydir) # Save individual output files
-    if save_new_IC:
-        SaveInitialConditions(swwvals, mydir, -1,
-                              IC_depth_dest,IC_xmom_dest,IC_ymom_dest) # Save new IC
+sww_file = os.path.join(mydir,'WLAD2.sww')
+SaveOutputsParallel(sww_file, mydir) # Save individual output files
+if myid == 0 and save_new_IC:
+    SaveInitialConditions(sww_file, mydir, -1, IC_dest) # Save new IC
+
+# ---------------------------------------------------------------
+# Finalize
+# ---------------------------------------------------------------
+finalize()
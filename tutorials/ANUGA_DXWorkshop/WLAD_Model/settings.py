@@ -64,27 +64,76 @@ ID_NOAA_Wind = int(ID_LAWMA if wind_source=='lawma' else ID_Eugene)
 name_Wind = 'BoundaryConditions/Wind_%s_%s-%s.csv' % (wind_source,
              UTC_starttime[0:10].replace('-',''),CDT_dates[1].replace('-',''))
 
+# Binary bundle of the tide, wind and discharge series above, rebuilt
+# whenever the csv files or tide offsets change
+forcing_bundle = r'BoundaryConditions/Forcing.npz'
+
 # MESH SETTINGS-----------------------------------------------------------------
 base_res = 625 # 25m res, background resolution outside interior polygons
+# Folder caching generated meshes, keyed by the polygons and resolutions (None = off)
+mesh_cache_dir = r'BathymetryPolygons/MeshCache'
+# Load the domain from files written by prepare_partition.py, one per
+# processor, instead of distributing it from processor 0
+use_partition_files = False
+partition_dir = r'Partitions'
+# Balance the partitions by expected work rather than cell count, using the
+# fraction of time each cell is wet: None, 'class' or 'depth'
+partition_weighting = None
+# Wet fraction of friction classes 1-6 for 'class' weighting
+class_wet_fraction = [1.0, 1.0, 1.0, 1.0, 0.5, 0.1]
+# Depths of a previous run on this mesh (data/depth.npy) for 'depth' weighting
+partition_depth_source = r'BoundaryConditions/depth.npy'
+# Relative cost of a dry cell, compared with 1 for a wet cell
+partition_dry_weight = 0.2
 
 # INITIAL CONDITIONS------------------------------------------------------------
 # Input file for topographic data
 topography_source = r'BathymetryPolygons/WLAD_topo.asc'
-# Hot start files from a previous run
-IC_depth_source = r'BoundaryConditions/IC_depth.csv'
-IC_xmom_source = r'BoundaryConditions/IC_xmom.csv'
-IC_ymom_source = r'BoundaryConditions/IC_ymom.csv'
-IC_source_run = r'220209_1551_WLAD2_2103' # Indicate source of IC files for reproducibility
-# Name of new IC files if saving for future restart
-IC_depth_dest = r'BoundaryConditions/IC_depth_restart.csv'
-IC_xmom_dest = r'BoundaryConditions/IC_xmom_restart.csv'
-IC_ymom_dest = r'BoundaryConditions/IC_ymom_restart.csv'
+# Hot start file from a previous run, i.e. depth, xmom and ymom at each
+# centroid. The .json of the same name records its source run and mesh
+IC_source = r'BoundaryConditions/IC.npy'
+# Name of new IC file if saving for future restart
+IC_dest = r'BoundaryConditions/IC_restart.npy'
 
 # FRICTION----------------------------------------------------------------------
 # Define friction parameters for classes 1-6, i.e.
 # [ocean, channels, small channels, subtidal, intertidal, supratidal]
 friction_loc = r'BoundaryConditions/FrictionMap.tif'
+# Folder caching the raster values sampled at the mesh centroids (None = off)
+friction_cache_dir = r'BoundaryConditions/FrictionCache'
 n_array = [0.015, 0.028, 0.005,     0,     0,     0]
 m_array = [    0,     0,     0,   120,   200,   200]
 h_array = [    0,     0,     0,   0.5,   1.0,    10]
 D_array = [    0,     0,     0,  0.01,  0.01, 0.015]
+# Class given to cells off the friction raster (ID 0), 6 = supratidal
+friction_nodata_class = 6
+# Time discretisation of the Baptist drag, 'explicit' or 'semi_implicit'.
+# Semi-implicit drag is stable in shallow dense marsh at the full DE1 CFL
+veg_drag_scheme = 'semi_implicit'
+# Model time (s) between applications of the Baptist operator, which is then
+# applied with the accumulated timestep, e.g. 60. Needs veg_drag_scheme =
+# 'semi_implicit'. None (default) applies it every timestep as before: setting
+# an interval changes the time discretisation of the drag. The inlets and
+# outlets always stay on every timestep, as applying Q*operator_interval in a
+# single step could remove more water than a small outlet cell holds
+operator_interval = None
+
+# CHECKPOINTS-------------------------------------------------------------------
+# Save the model state to the checkpoints folder of the run, every
+# checkpoint_step yieldsteps, or every checkpoint_walltime seconds of
+# walltime if set, so a run cut off by the job time limit can be resumed
+checkpoint_on = True
+checkpoint_step = 24
+checkpoint_walltime = 3600.
+# Run folder of an interrupted run, e.g. '/Outputs/210320_0000_WLAD2_2103_7day',
+# to resume from its latest complete set of checkpoints, on the same number
+# of processors. It is appended to rather than starting a new run folder
+restart_dir = None
+
+# OUTPUTS-----------------------------------------------------------------------
+# Memory budget (MB) for each chunk of timesteps read from the .sww file
+# when saving the individual output files
+output_chunk_mb = 512
+# Processes used to save the output files in serial runs (parallel runs
+# split the timesteps across the MPI processors instead)
+output_processes = 1
@@ -7,22 +7,206 @@ Background functions used to setup ANUGA simulation
 from __future__ import division
 import numpy as np
 import pandas as pd
-from scipy.interpolate import interp1d
-from osgeo import gdal
 import os
 import glob
+import re
+import math
+import bisect
+import contextlib
+import json
+import hashlib
 import anuga
+from anuga.file.netcdf import NetCDFFile
+from anuga.config import netcdf_mode_r, netcdf_mode_w
 from .settings import *
 
+# ------------------------------------------------------------------------------
+# Parallel functions
+# ------------------------------------------------------------------------------
+def Broadcast(obj, root=0):
+    """
+    Function to send a python object from processor root to all the others,
+    e.g. inputs read once on processor 0. Must be called on every processor.
+    Returns the object on every processor
+    """
+    if anuga.numprocs == 1:
+        return obj
+    try:
+        from mpi4py import MPI
+    except ImportError: # Fall back on the point to point interface
+        if anuga.myid == root:
+            for proc in range(anuga.numprocs):
+                if proc != root:
+                    anuga.send(obj, proc)
+            return obj
+        return anuga.receive(root)
+    return MPI.COMM_WORLD.bcast(obj, root=root)
+
 # ------------------------------------------------------------------------------
 # Boundary condition functions
 # ------------------------------------------------------------------------------
+class TimeSeries(object):
+    """
+    Forcing time series held as contiguous float64 arrays of times and
+    values. Call with a time, or an array of times, to interpolate either
+    'linear'ly or with the 'previous' value, matching scipy's interp1d.
+    Uniformly spaced series find the interval by index arithmetic, others
+    by bisection. Times outside the series raise a ValueError, unless
+    bounds_error is False when the end values are used.
+    """
+    def __init__(self, times, values, kind='linear', bounds_error=True):
+        times = np.ascontiguousarray(times, dtype=float)
+        values = np.ascontiguousarray(values, dtype=float)
+        if kind not in ['linear', 'previous']:
+            raise ValueError("kind must be 'linear' or 'previous', not %s" % kind)
+        if times.ndim != 1 or times.shape != values.shape or len(times) == 0:
+            raise ValueError('times and values must be 1D arrays of equal length')
+        steps = np.diff(times)
+        if np.any(steps <= 0):
+            raise ValueError('times must be strictly increasing')
+        self.times = times
+        self.values = values
+        self.kind = kind
+        self.bounds_error = bounds_error
+        self.uniform = len(steps) > 0 and bool(np.all(steps == steps[0]))
+        self.step = float(steps[0]) if len(steps) > 0 else 0.
+        # Python floats for evaluating single times without numpy overhead
+        self._times = times.tolist()
+        self._values = values.tolist()
+
+    def check_bounds(self, t):
+        """
+        Raise a ValueError for times outside the series, or clip them to
+        the series if bounds_error is False
+        """
+        start, end = self._times[0], self._times[-1]
+        if isinstance(t, float):
+            if start <= t <= end:
+                return t
+        elif np.all((t >= start) & (t <= end)):
+            return t
+        if self.bounds_error:
+            raise ValueError('Time is outside the range of the series, %s to %s'
+                             % (start, end))
+        if isinstance(t, float):
+            return min(max(t, start), end)
+        return np.clip(t, start, end)
+
+    def locate(self, t):
+        """
+        Index of the last time <= t, for t within the series
+        """
+        n = len(self._times)
+        if isinstance(t, float):
+            if not self.uniform:
+                return bisect.bisect_right(self._times, t) - 1
+            j = min(max(int(math.floor((t - self._times[0])/self.step)), 0), n-1)
+            # Correct any rounding in the index arithmetic
+            if self._times[j] > t:
+                j -= 1
+            elif j < n-1 and self._times[j+1] <= t:
+                j += 1
+            return j
+        if not self.uniform:
+            return np.searchsorted(self.times, t, side='right') - 1
+        j = np.floor((t - self.times[0])/self.step).astype(int)
+        j = np.clip(j, 0, n-1)
+        j -= self.times[j] > t
+        j += (j < n-1) & (self.times[np.minimum(j+1, n-1)] <= t)
+        return j
+
+    def __call__(self, t):
+        """
+        Value of the series at time(s) t, a float or numpy.ndarray
+        """
+        if np.ndim(t) == 0:
+            t = self.check_bounds(float(t))
+            j = self.locate(t)
+            x, y = self._times, self._values
+            if self.kind == 'previous' or t == x[j]:
+                return y[j]
+            slope = (y[j+1] - y[j]) / (x[j+1] - x[j])
+            return slope*(t - x[j]) + y[j]
+        t = self.check_bounds(np.asarray(t, dtype=float))
+        j = self.locate(t)
+        if self.kind == 'previous' or len(self._times) == 1:
+            return self.values[j]
+        k = np.minimum(j, len(self._times)-2) # Interval, also for t at the end
+        x, y = self.times, self.values
+        slope = (y[k+1] - y[k]) / (x[k+1] - x[k])
+        return np.where(t == x[j], y[j], slope*(t - x[k]) + y[k])
+
+def SaveForcing(filename, forcing, key=''):
+    """
+    Function to save a dict of TimeSeries in a single binary .npz bundle,
+    with a key identifying the data they were made from
+    """
+    arrays = {'key': np.array(key)}
+    for name, series in forcing.items():
+        arrays[name + '_times'] = series.times
+        arrays[name + '_values'] = series.values
+        arrays[name + '_kind'] = np.array(series.kind)
+        arrays[name + '_bounds_error'] = np.array(series.bounds_error)
+    # Write then rename, so other processes never see a partial file
+    tmp = '%s.%d.tmp.npz' % (os.path.splitext(filename)[0], os.getpid())
+    np.savez(tmp, **arrays)
+    os.replace(tmp, filename)
+    return
+
+def LoadForcing(filename):
+    """
+    Function to load a bundle saved by SaveForcing.
+    Returns a dict of TimeSeries and the key of the bundle
+    """
+    with np.load(filename, allow_pickle=False) as bundle:
+        names = [k[:-len('_times')] for k in bundle.files if k.endswith('_times')]
+        forcing = {}
+        for name in names:
+            forcing[name] = TimeSeries(bundle[name + '_times'],
+                                       bundle[name + '_values'],
+                                       kind=str(bundle[name + '_kind']),
+                                       bounds_error=bool(bundle[name + '_bounds_error']))
+        key = str(bundle['key'])
+    return forcing, key
+
+def GenerateForcing(filename=forcing_bundle, wind=wind_on):
+    """
+    Function to generate all the gauge forcings, i.e. 'tides', 'Q_WLO',
+    'Q_ATC', 'Q_FRA' and, if wind, 'windspeed' and 'winddir'.
+    Series are saved to a binary bundle and reloaded from it while the
+    data files and settings are unchanged, skipping the csv parsing.
+    Specify inputs in settings.py. Returns a dict of TimeSeries
+    """
+    sources = [name_Tides, name_WLO, name_ATC, name_FRA]
+    if wind:
+        sources.append(name_Wind)
+    key = hashlib.sha1(repr([tide_timeoffset, tide_vertoffset,
+                             Q_steady, sources]).encode())
+    for source in sources:
+        key.update(FileChecksum(source).encode())
+    key = key.hexdigest()
+
+    if filename is not None and os.path.exists(filename):
+        forcing, saved_key = LoadForcing(filename)
+        if saved_key == key:
+            return forcing
+
+    forcing = {'tides': GenerateTideGauge(),
+               'Q_WLO': GenerateHydrograph(name_WLO), # Calumet inlet
+               'Q_ATC': GenerateHydrograph(name_ATC), # Morgan City inlet
+               'Q_FRA': GenerateHydrograph(name_FRA)} # Franklin outlet
+    if wind:
+        forcing['windspeed'], forcing['winddir'] = GenerateWind()
+    if filename is not None:
+        SaveForcing(filename, forcing, key)
+    return forcing
+
 def GenerateTideGauge(filename=name_Tides,
                       time_offset=tide_timeoffset,
                       vert_offset=tide_vertoffset):
     """
     Function to generate a tidal BC from gauge data.
-    Specify inputs in settings.py. Returns a function of time.
+    Specify inputs in settings.py. Returns a TimeSeries.
     """
     # Measured water levels
     tides = pd.read_csv(filename, header=0, names=['datetime', 'WL'])
@@ -31,7 +215,7 @@ def GenerateTideGauge(filename=name_Tides,
     # Convert date string to datetime, create new column epoch for int numeric time
     tides['datetime'] = pd.to_datetime(tides['datetime'])
     tides['epoch'] = (tides['datetime'] - tides['datetime'][0] - time_offset) // pd.Timedelta("1s")
-    fBC_tides = interp1d(tides['epoch'], tides['WL'] + vert_offset, kind='linear')
+    fBC_tides = TimeSeries(tides['epoch'], tides['WL'] + vert_offset, kind='linear')
     return fBC_tides
 
 def GenerateTideCosine(amplitude=0.25, period=7.2722e-5, phase=0, offset=0.26):
@@ -48,7 +232,7 @@ def GenerateTideCosine(amplitude=0.25, period=7.2722e-5, phase=0, offset=0.26):
 def GenerateWind(filename=name_Wind):
     """
     Function to generate a wind forcing from gauge data.
-    Specify inputs in settings.py. Returns two functions of time.
+    Specify inputs in settings.py. Returns two TimeSeries.
     In output, 0 degrees is from the West, 90 degrees is from the North.
     """
     # NOAA Amerada Pass, [m/s], direction FROM (0 is from N, 90 is from E, etc)
@@ -59,26 +243,25 @@ def GenerateWind(filename=name_Wind):
     met['datetime'] = pd.to_datetime(met['datetime'])
     met['epoch'] = (met['datetime'] - met['datetime'][0]) // pd.Timedelta("1s")
     # Linearly interpolate wind speeds at each time:
-    fBC_windspeed = interp1d(met['epoch'], met['speed'], kind='linear')
+    fBC_windspeed = TimeSeries(met['epoch'], met['speed'], kind='linear')
     # Use previous 6-min direction value over window:
-    fBC_winddir = interp1d(met['epoch'], wind_dir, kind='previous')
+    fBC_winddir = TimeSeries(met['epoch'], wind_dir, kind='previous')
     return fBC_windspeed, fBC_winddir
 
 def GenerateHydrograph(filename, steady=Q_steady):
     """
     Function to generate a hydrograph from USGS gauge data.
-    Specify inputs in settings.py. Returns a function of time.
+    Specify inputs in settings.py. Returns a TimeSeries.
     When calling, filename either name_WLO, name_ATC, name_FRA
     """
     Q = pd.read_csv(filename, header=0, 
                     names = ['datetime','Q'])
     if steady:
-        def fQ(t):
-            return np.mean(Q['Q'])
+        fQ = TimeSeries([0.], [np.mean(Q['Q'])], bounds_error=False) # Constant
     else:
         Q['datetime'] = pd.to_datetime(Q['datetime'])
         Q['epoch'] = (Q['datetime'] - Q['datetime'][0]) // pd.Timedelta("1s")
-        fQ = interp1d(Q['epoch'], Q['Q'], kind='linear')
+        fQ = TimeSeries(Q['epoch'], Q['Q'], kind='linear')
     return fQ
 
 # ------------------------------------------------------------------------------
@@ -88,10 +271,12 @@ def Raster2Mesh(meshX, meshY, raster_filename=friction_loc):
     """
     Function to grab raster value at each mesh cell centroid.
     Used for friction assignment. Specify raster in settings.py.
-    Returns a numpy.ndarray
+    Only the raster window covering the given points is read, and points
+    off the raster get 0. Returns a numpy.ndarray
     """
+    from osgeo import gdal # Only needed here
     src = gdal.Open(raster_filename)
-    data_array = np.array(src.GetRasterBand(1).ReadAsArray())
+    band = src.GetRasterBand(1)
     # Get geographic info
     transform = src.GetGeoTransform()
     xOrigin = transform[0]
@@ -99,18 +284,110 @@ def Raster2Mesh(meshX, meshY, raster_filename=friction_loc):
     pixelWidth = transform[1]
     pixelHeight = -transform[5]
 
-    # Loop and grab all values at mesh coords
-    meshVal = np.zeros(len(meshX), dtype=int)
-    for ii in list(range(0, len(meshX))):
-        col = int((meshX[ii] - xOrigin) / pixelWidth)
-        row = int((yOrigin - meshY[ii] ) / pixelHeight)
-        try:
-            meshVal[ii] = data_array[row][col]
-        except IndexError:
-            meshVal[ii] = 0
+    # Pixel of every mesh coord, truncated towards zero as int() does
+    col = ((np.asarray(meshX, dtype=float) - xOrigin) / pixelWidth).astype(int)
+    row = ((yOrigin - np.asarray(meshY, dtype=float)) / pixelHeight).astype(int)
+    inside = ((row >= 0) & (row < src.RasterYSize) &
+              (col >= 0) & (col < src.RasterXSize))
+
+    meshVal = np.zeros(len(col), dtype=int)
+    if not inside.any():
+        return meshVal
+    row = row[inside]
+    col = col[inside]
+
+    # Read the bounding window of the points only
+    xoff, yoff = int(col.min()), int(row.min())
+    xsize, ysize = int(col.max()) - xoff + 1, int(row.max()) - yoff + 1
+    data_array = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    meshVal[inside] = data_array[row - yoff, col - xoff]
     # Return values
     return meshVal
 
+def FileChecksum(filename, cache_dir=None):
+    """
+    Function to compute the sha1 checksum of a file. If cache_dir is given,
+    checksums are remembered there by file size and modification time so
+    that an unchanged file is not read again. Only processor 0 writes to
+    the cache. Returns a hex string.
+    """
+    stat = os.stat(filename)
+    key = os.path.abspath(filename)
+    stamp = [stat.st_size, stat.st_mtime]
+    sidecar = None
+    if cache_dir is not None:
+        sidecar = os.path.join(cache_dir, 'checksums.json')
+        try:
+            with open(sidecar) as f:
+                known = json.load(f)
+            if known[key]['stamp'] == stamp:
+                return known[key]['sha1']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    checksum = sha1.hexdigest()
+
+    if sidecar is not None and anuga.myid == 0:
+        try:
+            with open(sidecar) as f:
+                known = json.load(f)
+        except (IOError, OSError, ValueError):
+            known = {}
+        known[key] = {'stamp': stamp, 'sha1': checksum}
+        tmp = '%s.%d.tmp' % (sidecar, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(known, f)
+        os.replace(tmp, sidecar)
+    return checksum
+
+def Raster2MeshCached(meshX, meshY, raster_filename=friction_loc,
+                      cache_dir=friction_cache_dir, parallel=False):
+    """
+    Function to grab raster value at each mesh cell centroid, as Raster2Mesh,
+    through a cache keyed by the centroid coordinates and the raster
+    checksum. Values are stored in cache_dir as compact .npy files, so runs
+    on an unchanged mesh and raster skip the raster entirely.
+    If parallel, it must be called on every processor (each with its own
+    cells): the raster checksum is then computed on processor 0 only and
+    broadcast. If cache_dir is None, this is Raster2Mesh.
+    Returns a numpy.ndarray
+    """
+    if cache_dir is None:
+        return Raster2Mesh(meshX, meshY, raster_filename)
+    if parallel:
+        if anuga.myid == 0 and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        checksum = Broadcast(FileChecksum(raster_filename, cache_dir)
+                             if anuga.myid == 0 else None)
+    else:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        checksum = FileChecksum(raster_filename, cache_dir)
+
+    key = hashlib.sha1()
+    key.update(np.ascontiguousarray(meshX, dtype=float).tobytes())
+    key.update(np.ascontiguousarray(meshY, dtype=float).tobytes())
+    key.update(checksum.encode())
+    cache_file = os.path.join(cache_dir, 'raster2mesh_%s.npy' % key.hexdigest())
+
+    if os.path.exists(cache_file):
+        return np.load(cache_file).astype(int)
+
+    meshVal = Raster2Mesh(meshX, meshY, raster_filename)
+    if len(meshVal) == 0 or (meshVal.min() >= 0 and meshVal.max() < 256):
+        stored = meshVal.astype(np.uint8)
+    else:
+        stored = meshVal.astype(np.int32)
+    # Write then rename, so other processes never see a partial file
+    tmp = '%s.%d.tmp.npy' % (cache_file[:-4], os.getpid())
+    np.save(tmp, stored, allow_pickle=False)
+    os.replace(tmp, cache_file)
+    return meshVal
+
 def AssignFricValue(FricVal,
                     n_array=n_array,
                     m_array=m_array,
@@ -121,19 +398,33 @@ def AssignFricValue(FricVal,
     All Mannings (n) and Baptist (m, hv, D) values returned.
     Specify coefficients for each class in settings.py
     """
-    FricVal = FricVal.astype(int)-1 # Subtract 1 assuming map ID's start at 1
-    n = np.zeros_like(FricVal, dtype=float)
-    m = np.zeros_like(FricVal, dtype=float)
-    hv = np.zeros_like(FricVal, dtype=float)
-    D = np.zeros_like(FricVal, dtype=float)
-    
-    for ii in list(range(len(FricVal))):
-        n[ii] = n_array[FricVal[ii]]
-        m[ii] = m_array[FricVal[ii]]
-        hv[ii] = h_array[FricVal[ii]]
-        D[ii] = D_array[FricVal[ii]]
+    FricClass = AssignFricClass(FricVal, n_classes=len(n_array))
+    # One row per parameter, one column per class, gathered in one pass
+    table = np.array([n_array, m_array, h_array, D_array], dtype=float)
+    n, m, hv, D = table[:, FricClass]
     return n, m, hv, D
 
+def AssignFricClass(FricVal, n_classes=len(n_array),
+                    nodata_class=friction_nodata_class):
+    """
+    Using Friction ID (output of Raster2Mesh), return the class index of
+    each cell (0 to n_classes-1) as a compact uint8 array, for use as a
+    lookup into the per-class parameter lists in settings.py.
+    Map IDs start at 1, cells off the raster (ID 0) get nodata_class.
+    Raises ValueError for any other ID outside 1 to n_classes.
+    """
+    FricVal = np.asarray(FricVal).astype(int)
+    FricVal = np.where(FricVal == 0, nodata_class, FricVal)
+    bad = (FricVal < 1) | (FricVal > n_classes)
+    if bad.any():
+        msg = ('Friction IDs must be 0 (off raster) or 1 to %d, '
+               'found %s in %d cells' % (n_classes,
+                                         np.unique(FricVal[bad]).tolist(),
+                                         bad.sum()))
+        raise ValueError(msg)
+    FricClass = FricVal - 1 # Subtract 1 assuming map ID's start at 1
+    return FricClass.astype(np.uint8)
+
 def GenerateDomainGeometry():
     """
     Function to generate inputs for the domain instance.
@@ -149,7 +440,7 @@ def GenerateDomainGeometry():
                              16,17,18,19,20,21,22,23,24,25,26,27]}
 
     # ---------------Load in polygons-------------------
-    polygon_files = glob.glob(r'BathymetryPolygons/*Reg*.csv')
+    polygon_files = sorted(glob.glob(r'BathymetryPolygons/*Reg*.csv'))
     inside_regions = []
     for poly in polygon_files:
         polyres = int(poly.split('_Res')[-1].replace('.csv',''))
@@ -164,59 +455,681 @@ def GenerateDomainGeometry():
 
     return bounding_polygon, boundary_tags, inside_regions, geo_reference
 
+def GeoReferenceFields(geo_reference):
+    """
+    Function to list the fields defining a Geo_reference, as keyword
+    arguments to anuga.Geo_reference. Returns a dict
+    """
+    names = ['zone', 'xllcorner', 'yllcorner', 'datum', 'projection',
+             'units', 'false_easting', 'false_northing']
+    return {name: getattr(geo_reference, name) for name in names}
+
+def CreateDomainCached(bounding_polygon, boundary_tags, inside_regions,
+                       geo_reference, maximum_triangle_area=base_res,
+                       cache_dir=mesh_cache_dir, **kwargs):
+    """
+    Function to create the domain with anuga.create_domain_from_regions,
+    through a cache keyed by the bounding and region polygons, their
+    resolutions, maximum_triangle_area, boundary tags and geo reference.
+    Meshes are stored in cache_dir as .npz files, so a repeated geometry
+    skips the triangulation. Inputs are the outputs of
+    GenerateDomainGeometry, other keyword arguments are passed on to
+    create_domain_from_regions. If cache_dir is None, the mesh is always
+    generated. Returns an anuga.Domain
+    """
+    def create():
+        return anuga.create_domain_from_regions(bounding_polygon, boundary_tags,
+                                                maximum_triangle_area=maximum_triangle_area,
+                                                interior_regions=inside_regions,
+                                                poly_geo_reference=geo_reference,
+                                                mesh_geo_reference=geo_reference,
+                                                **kwargs)
+    if cache_dir is None:
+        return create()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    key = hashlib.sha1()
+    key.update(np.ascontiguousarray(bounding_polygon, dtype=float).tobytes())
+    for polygon, res in inside_regions:
+        polygon = np.ascontiguousarray(polygon, dtype=float)
+        key.update(repr((polygon.shape, res)).encode())
+        key.update(polygon.tobytes())
+    key.update(repr([sorted(boundary_tags.items()), maximum_triangle_area,
+                     sorted(GeoReferenceFields(geo_reference).items())]).encode())
+    cache_file = os.path.join(cache_dir, 'mesh_%s.npz' % key.hexdigest())
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as mesh:
+            boundary = {}
+            for (vol_id, edge_id), tag in zip(mesh['boundary_ids'].tolist(),
+                                              mesh['boundary_tags'].tolist()):
+                boundary[(vol_id, edge_id)] = tag
+            tagged_ids = np.split(mesh['tagged_ids'],
+                                  np.cumsum(mesh['tagged_counts'])[:-1])
+            tagged_elements = dict(zip(mesh['tagged_tags'].tolist(), tagged_ids))
+            georef = anuga.Geo_reference(**{name[7:]: mesh[name].item()
+                                            for name in mesh.files
+                                            if name.startswith('georef_')})
+            return anuga.Domain(mesh['nodes'], mesh['triangles'], boundary,
+                                tagged_elements=tagged_elements,
+                                geo_reference=georef)
+
+    domain = create()
+    tagged = domain.get_tagged_elements()
+    arrays = {'nodes': domain.nodes,
+              'triangles': domain.triangles,
+              'boundary_ids': np.array(list(domain.boundary.keys()),
+                                       dtype=int).reshape(-1, 2),
+              'boundary_tags': np.array(list(domain.boundary.values()), dtype=str),
+              'tagged_tags': np.array(list(tagged.keys()), dtype=str),
+              'tagged_counts': np.array([len(ids) for ids in tagged.values()],
+                                        dtype=int),
+              'tagged_ids': np.concatenate([np.asarray(ids, dtype=int)
+                                            for ids in tagged.values()] +
+                                           [np.zeros(0, dtype=int)])}
+    for name, value in GeoReferenceFields(domain.geo_reference).items():
+        arrays['georef_' + name] = np.array(value)
+    # Write then rename, so other processes never see a partial file
+    tmp = '%s.%d.tmp.npz' % (cache_file[:-4], os.getpid())
+    np.savez(tmp, **arrays)
+    os.replace(tmp, cache_file)
+    return domain
+
+def GenerateDomain(fBC_tides=None):
+    """
+    Function to create the full domain, i.e. mesh, elevation and the
+    initial stage of a cold start. Hot starts replace the stage once
+    distributed. fBC_tides is the tidal BC, used for the initial water
+    level unless T_steady. Specify inputs in settings.py.
+    Returns an anuga.Domain
+    """
+    bounding_polygon, boundary_tags, inside_regions, geo_reference = GenerateDomainGeometry()
+
+    domain = CreateDomainCached(bounding_polygon, boundary_tags,
+                                inside_regions, geo_reference,
+                                maximum_triangle_area=base_res,
+                                mesh_filename = 'WLAD2.msh')
+    domain.set_name('WLAD2')
+    domain.set_flow_algorithm('DE1')
+    domain.set_low_froude(1)  # Use low-froude DE1 to reduce flux damping
+    domain.set_minimum_allowed_height(0.005)  # Only store heights > 0.5 cm
+
+    # ---------------Load pre-established elevation----------------------
+    topo = np.loadtxt(topography_source.replace('.asc','.csv'), delimiter=",")
+
+    stage = topo.copy()  # Initialize stage as = topography
+    if not T_steady:
+        stage[topo <= fBC_tides(0)] = fBC_tides(0) # Used for cold start
+    else:
+        stage[topo <= steady_T_elev] = steady_T_elev
+    domain.set_quantity('elevation', topo, location='centroids')
+    domain.set_quantity('stage', stage, location='centroids')  # Initialize depth
+    return domain
+
+def DumpPartitions(domain, numprocs, partition_dir=partition_dir,
+                   weights=None, verbose=False):
+    """
+    Function to partition the full domain for numprocs processors and
+    write one file per processor to partition_dir, for LoadPartition.
+    Partitions balance the cell weights if given (GeneratePartitionWeights).
+    The friction class of every cell and the DomainFingerprint are saved
+    alongside, for slicing by processor and checking hot start files
+    """
+    with WeightedPartitioning(weights):
+        anuga.sequential_distribute_dump(domain, numprocs, verbose=verbose,
+                                         partition_dir=partition_dir)
+    x = domain.quantities['x'].centroid_values
+    y = domain.quantities['y'].centroid_values
+    FricClass = AssignFricClass(Raster2MeshCached(x, y))
+    name = os.path.join(partition_dir, domain.get_name())
+    np.save(name + '_friction_class.npy', FricClass, allow_pickle=False)
+    with open(name + '_mesh.json', 'w') as f:
+        json.dump(DomainFingerprint(domain), f)
+    return
+
+def LoadPartition(name='WLAD2', partition_dir=partition_dir):
+    """
+    Function to load the part of the domain on this processor, written by
+    DumpPartitions for the current number of processors.
+    Returns the domain and the friction class of its cells
+    """
+    pickle_name = os.path.join(partition_dir, '%s_P%g_%g.pickle'
+                               % (name, anuga.numprocs, anuga.myid))
+    if not os.path.exists(pickle_name):
+        msg = ('No partition of %s for %d processors in %s, run '
+               'prepare_partition.py first' % (name, anuga.numprocs, partition_dir))
+        raise Exception(msg)
+    domain = anuga.sequential_distribute_load(filename=name,
+                                              partition_dir=partition_dir)
+    FricClass = np.load(os.path.join(partition_dir, name + '_friction_class.npy'),
+                        mmap_mode='r')
+    return domain, np.array(FricClass[LocalTriangleIds(domain)])
+
+def PartitionFingerprint(name='WLAD2', partition_dir=partition_dir):
+    """
+    Function to load the DomainFingerprint saved by DumpPartitions.
+    Returns a dict
+    """
+    with open(os.path.join(partition_dir, name + '_mesh.json')) as f:
+        return json.load(f)
+
+def WetFraction(depth_file, wet_depth=0.005, chunk_mb=output_chunk_mb):
+    """
+    Function to compute the fraction of time each cell was wet, from the
+    depth output (depth.npy, see SaveOutputs) of a previous run on the
+    same mesh, read in chunks of timesteps. Returns a numpy.ndarray
+    """
+    depth = np.load(depth_file, mmap_mode='r')
+    wet = np.zeros(depth.shape[1])
+    chunk = max(1, int(chunk_mb*2**20 // (5*depth.shape[1] + 1)))
+    for t0 in range(0, len(depth), chunk):
+        wet += (depth[t0:t0+chunk] > wet_depth).sum(axis=0)
+    return wet/max(len(depth), 1)
+
+def GeneratePartitionWeights(domain, weighting=partition_weighting,
+                             dry_weight=partition_dry_weight):
+    """
+    Function to estimate the relative cost of each cell of the full domain,
+    dry_weight for a cell that is always dry up to 1 for one always wet.
+    The wet fraction comes from the friction class of each cell
+    (weighting='class') or the depths of a previous run ('depth').
+    Specify inputs in settings.py. Returns integer weights for
+    WeightedPartitioning, or None if weighting is None
+    """
+    if weighting is None:
+        return None
+    if weighting == 'class':
+        x = domain.quantities['x'].centroid_values
+        y = domain.quantities['y'].centroid_values
+        FricClass = AssignFricClass(Raster2MeshCached(x, y))
+        wet = np.asarray(class_wet_fraction, dtype=float)[FricClass]
+    elif weighting == 'depth':
+        wet = WetFraction(partition_depth_source)
+        if len(wet) != len(domain):
+            msg = ('Depths in %s have %d cells but the mesh has %d'
+                   % (partition_depth_source, len(wet), len(domain)))
+            raise Exception(msg)
+    else:
+        raise ValueError("weighting must be None, 'class' or 'depth', not %s"
+                         % weighting)
+    cost = dry_weight + (1. - dry_weight)*np.clip(wet, 0., 1.)
+    return np.maximum(np.round(100*cost), 1).astype(np.int32)
+
+def WeightedBisection(x, y, weights, n_parts):
+    """
+    Function to split cells into n_parts of near equal total weight by
+    recursive bisection of their coordinates x, y, cutting each part
+    across its longer side. Returns the part of each cell
+    """
+    epart = np.zeros(len(x), dtype=int)
+    def split(ids, first, n):
+        if n == 1:
+            epart[ids] = first
+            return
+        n_left = n // 2
+        coord = x[ids] if np.ptp(x[ids]) >= np.ptp(y[ids]) else y[ids]
+        ids = ids[np.argsort(coord, kind='mergesort')]
+        cum = np.cumsum(weights[ids])
+        cut = np.searchsorted(cum, cum[-1]*n_left/n)
+        cut = min(max(cut, n_left), len(ids) - (n - n_left)) # No empty parts
+        split(ids[:cut], first, n_left)
+        split(ids[cut:], first + n_left, n - n_left)
+    split(np.arange(len(x)), 0, n_parts)
+    return epart
+
+def WeightedPartition(domain, n_procs, weights):
+    """
+    Function to partition the triangles of the full domain between n_procs
+    processors, balancing the sum of the cell weights rather than the number
+    of cells. Uses METIS on the triangle adjacency graph if pymetis is
+    installed, otherwise WeightedBisection. Returns the part of each cell
+    """
+    weights = np.asarray(weights, dtype=np.int32)
+    if len(weights) != domain.number_of_triangles:
+        raise ValueError('Need one weight per triangle, got %d for %d'
+                         % (len(weights), domain.number_of_triangles))
+    if n_procs == 1:
+        return np.zeros(len(weights), dtype=int)
+    try:
+        from pymetis import part_graph
+    except ImportError:
+        xy = domain.centroid_coordinates
+        return WeightedBisection(xy[:,0], xy[:,1], weights, n_procs)
+    # Adjacency of the triangles, skipping boundary edges (negative neighbours)
+    neighbours = domain.neighbours
+    mask = neighbours >= 0
+    xadj = np.zeros(len(neighbours) + 1, dtype=np.int32)
+    np.cumsum(mask.sum(axis=1), out=xadj[1:])
+    adjncy = neighbours[mask].astype(np.int32)
+    cutcount, epart = part_graph(n_procs, xadj=xadj, adjncy=adjncy,
+                                 vweights=weights)
+    return np.asarray(epart, dtype=int)
+
+@contextlib.contextmanager
+def WeightedPartitioning(weights):
+    """
+    Context manager making anuga partition the mesh with WeightedPartition,
+    within distribute or sequential_distribute_dump (metis scheme).
+    weights are those of GeneratePartitionWeights, one per cell of the
+    full domain. If weights is None the partitioning is unchanged
+    """
+    if weights is None:
+        yield
+        return
+    from anuga.parallel import partitioning
+    metis_partition = partitioning.metis_partition
+    def weighted_partition(domain, n_procs):
+        epart = WeightedPartition(domain, n_procs, weights)
+        triangles_per_proc = np.bincount(epart, minlength=n_procs)
+        if np.any(triangles_per_proc == 0):
+            raise Exception('Partition created where at least one submesh has '
+                            'no triangles. Try using fewer processors.')
+        return np.argsort(epart, kind='mergesort'), triangles_per_proc
+    partitioning.metis_partition = weighted_partition
+    try:
+        yield
+    finally:
+        partitioning.metis_partition = metis_partition
+
+def MeshFingerprint(x, y, n_samples=1000):
+    """
+    Function to summarise a mesh by its number of cells and the absolute
+    centroid coordinates of a fixed sample of cells, for checking that
+    files saved on one mesh are loaded on the same mesh.
+    Returns a dict that can be saved as .json
+    """
+    ids = np.unique(np.linspace(0, len(x)-1, min(n_samples, len(x))).astype(int))
+    return {'cells': len(x),
+            'ids': ids.tolist(),
+            'x': np.round(np.asarray(x)[ids], 2).tolist(),
+            'y': np.round(np.asarray(y)[ids], 2).tolist()}
+
+def InitialConditionsInfo(IC_filename):
+    """
+    Function to name the .json saved alongside an IC file
+    """
+    return os.path.splitext(IC_filename)[0] + '.json'
+
+def DomainFingerprint(domain):
+    """
+    Function to compute the MeshFingerprint of a full (not yet distributed)
+    domain, from its absolute centroid coordinates. Returns a dict
+    """
+    xy = domain.centroid_coordinates
+    return MeshFingerprint(xy[:,0] + domain.geo_reference.get_xllcorner(),
+                           xy[:,1] + domain.geo_reference.get_yllcorner())
+
+def CheckInitialConditions(domain, IC_filename=IC_source, tol=1.0):
+    """
+    Function to check an IC file made by SaveInitialConditions matches the
+    mesh of the full (not yet distributed) domain, i.e. same number of
+    cells and sampled centroids within tol metres. domain can also be the
+    DomainFingerprint of the full domain, e.g. from PartitionFingerprint.
+    Raises an Exception if not. Returns the dict saved in the .json
+    """
+    with open(InitialConditionsInfo(IC_filename)) as f:
+        info = json.load(f)
+    mesh = domain if isinstance(domain, dict) else DomainFingerprint(domain)
+    ic = np.load(IC_filename, mmap_mode='r')
+    if ic.shape != (3, mesh['cells']) or info['cells'] != mesh['cells']:
+        msg = ('IC file %s has %d cells but the mesh has %d'
+               % (IC_filename, info['cells'], mesh['cells']))
+        raise Exception(msg)
+    # Same number of cells, so the same sample of cells
+    dx = np.abs(np.subtract(mesh['x'], info['x']))
+    dy = np.abs(np.subtract(mesh['y'], info['y']))
+    if len(dx) > 0 and max(dx.max(), dy.max()) > tol:
+        msg = ('IC file %s was saved on a different mesh, centroids differ '
+               'by up to %.1f m' % (IC_filename, max(dx.max(), dy.max())))
+        raise Exception(msg)
+    return info
+
+def LocalTriangleIds(domain):
+    """
+    Function to find the global id of each triangle of a domain, i.e. its
+    index in the mesh before distribute. Returns a numpy.ndarray
+    """
+    tri_l2g = getattr(domain, 'tri_l2g', None)
+    if tri_l2g is None: # Sequential domain
+        return np.arange(len(domain))
+    return np.asarray(tri_l2g)
+
+def LoadInitialConditions(domain, IC_filename=IC_source):
+    """
+    Function to load the IC of the cells on this processor from an IC file
+    made by SaveInitialConditions. The file is memory mapped, so only the
+    values of these cells are read. Check the file on the full domain first
+    with CheckInitialConditions. Returns depth, xmom, ymom
+    """
+    ic = np.load(IC_filename, mmap_mode='r')
+    depth, xmom, ymom = ic[:, LocalTriangleIds(domain)]
+    return depth, xmom, ymom
+
+# ------------------------------------------------------------------------------
+# Checkpoint functions
+# ------------------------------------------------------------------------------
+def ProcessorNames(numprocs, name='WLAD2'):
+    """
+    Function to give the domain name of each processor after distribute,
+    which adds _P<numprocs>_<processor> to the name of each part but
+    leaves a serial domain (numprocs = 1) unchanged. Returns a list
+    """
+    if numprocs == 1:
+        return [name]
+    return ['%s_P%d_%d' % (name, numprocs, proc) for proc in range(numprocs)]
+
+def CheckpointFile(checkpoint_dir, domain_name, time):
+    """
+    Function to give the checkpoint file of the domain (or processor) named
+    domain_name at time, as written by Domain.save_checkpoint. time is as in
+    the file names, or 'mesh' for the mesh file. Returns the file path
+    """
+    return os.path.join(checkpoint_dir, '%s_%s.npz' % (domain_name, time))
+
+def CheckCheckpoint(checkpoint_dir, time, numprocs, name='WLAD2'):
+    """
+    Function to check the checkpoint files of all numprocs processors at
+    time (as in the file names) can be read, and agree on the model time
+    and step counts. Raises an Exception if not
+    """
+    counters = []
+    for domain_name in ProcessorNames(numprocs, name):
+        mesh_file = CheckpointFile(checkpoint_dir, domain_name, 'mesh')
+        if not os.path.exists(mesh_file):
+            raise Exception('Missing %s' % mesh_file)
+        filename = CheckpointFile(checkpoint_dir, domain_name, time)
+        with np.load(filename) as state:
+            model_time = float(state['starttime']) + float(state['relative_time'])
+            if abs(model_time - float(time)) > 1e-6*max(1., abs(model_time)):
+                msg = '%s holds time %s' % (filename, model_time)
+                raise Exception(msg)
+            counters.append((int(state['yieldstep_counter']),
+                             int(state['number_of_steps'])))
+    if len(set(counters)) > 1:
+        raise Exception('Processors are at different steps: %s' % set(counters))
+
+def LatestCheckpoint(checkpoint_dir, numprocs, name='WLAD2'):
+    """
+    Function to find the latest time with checkpoint files from all numprocs
+    processors that pass CheckCheckpoint. Older times are tried if the
+    latest set is incomplete, e.g. the job ended while writing it.
+    Returns the time as used in the checkpoint file names
+    """
+    procs = dict((domain_name, proc) for proc, domain_name
+                 in enumerate(ProcessorNames(numprocs, name)))
+    pattern = re.compile(r'^(.+)_([^_]+)\.npz$') # <domain name>_<time>.npz
+    times = {}
+    for filename in os.listdir(checkpoint_dir):
+        match = pattern.match(filename)
+        if match and match.group(1) in procs and match.group(2) != 'mesh':
+            times.setdefault(match.group(2), set()).add(procs[match.group(1)])
+
+    complete = [time for time in times if len(times[time]) == numprocs]
+    for time in sorted(complete, key=float, reverse=True):
+        try:
+            CheckCheckpoint(checkpoint_dir, time, numprocs, name)
+        except Exception as e:
+            print('Skipping checkpoint at time %s: %s' % (time, e))
+            continue
+        return time
+    msg = 'No complete checkpoint for %d processors in %s' % (numprocs, checkpoint_dir)
+    raise Exception(msg)
+
+def TrimSWW(sww_file, time, chunk_mb=output_chunk_mb):
+    """
+    Function to drop the timesteps stored after time (relative model time)
+    from an sww file, e.g. those after the checkpoint a run restarts from,
+    so the restarted run can append to it. The kept timesteps are copied
+    to a new file in chunks, which replaces sww_file.
+    Returns the number of timesteps kept
+    """
+    fid = NetCDFFile(sww_file, netcdf_mode_r)
+    fid.set_auto_mask(False)
+    times = np.asarray(fid.variables['time'][:])
+    nt = int(np.sum(times <= time + 1e-6*max(1., abs(time))))
+    if nt == len(times):
+        fid.close()
+        return nt
+
+    tmp_file = sww_file + '.tmp'
+    out = NetCDFFile(tmp_file, netcdf_mode_w)
+    out.set_auto_mask(False)
+    out.setncatts(dict((att, fid.getncattr(att)) for att in fid.ncattrs()))
+    for dim_name, dim in fid.dimensions.items():
+        out.createDimension(dim_name, None if dim.isunlimited() else len(dim))
+    for var_name, var in fid.variables.items():
+        new = out.createVariable(var_name, var.dtype, var.dimensions)
+        new.setncatts(dict((att, var.getncattr(att)) for att in var.ncattrs()))
+        if var.dimensions[:1] == ('number_of_timesteps',):
+            row_bytes = var.dtype.itemsize*int(np.prod(var.shape[1:]))
+            chunk = max(1, int(chunk_mb*2**20 // max(row_bytes, 1)))
+            for t0 in range(0, nt, chunk):
+                new[t0:min(t0+chunk, nt)] = var[t0:min(t0+chunk, nt)]
+        else:
+            new[...] = var[...]
+    out.close()
+    fid.close()
+    os.replace(tmp_file, sww_file)
+    return nt
+
 # ------------------------------------------------------------------------------
 # Post-processing functions
 # ------------------------------------------------------------------------------
-def SaveOutputs(swwvals, mydir):
+output_names = ['stage', 'depth', 'xmom', 'ymom', 'xvel', 'yvel', 'chezy']
+
+def ReadCentroidGeometry(fid):
+    """
+    Function to read the centroid coordinates and elevation from an open
+    .sww file, computed as anuga.utilities.plot_utils.get_centroids does.
+    Returns x, y, elev as numpy.ndarrays
+    """
+    vols = np.asarray(fid.variables['volumes'][:])
+    x = np.asarray(fid.variables['x'][:], dtype=float)
+    y = np.asarray(fid.variables['y'][:], dtype=float)
+    x_cent = (x[vols[:,0]] + x[vols[:,1]] + x[vols[:,2]]) / 3.0
+    y_cent = (y[vols[:,0]] + y[vols[:,1]] + y[vols[:,2]]) / 3.0
+    if 'stage_c' not in fid.variables:
+        raise Exception('Centroid values are not stored in the .sww file, '
+                        'use domain.set_store_centroids(True)')
+    elev_cent = np.asarray(fid.variables['elevation_c'][:], dtype=np.float32)
+    if elev_cent.ndim == 2:
+        elev_cent = elev_cent[0,:] # Elevation is static in these runs
+    return x_cent, y_cent, elev_cent
+
+def ReadCentroidSlices(fid, elev, t0, t1, minimum_allowed_height=1.0e-3):
+    """
+    Function to read timesteps t0 to t1 (exclusive) of the centroid values
+    from an open .sww file. Values match plot_utils.get_centroids().
+    Returns stage, depth, xmom, ymom, xvel, yvel, each of shape (t1-t0, N)
+    """
+    def read(name):
+        return np.asarray(fid.variables[name][t0:t1], dtype=np.float32)
+    stage = read('stage_c')
+    xmom = read('xmomentum_c')
+    ymom = read('ymomentum_c')
+    depth = stage - elev
+    # Velocities use the stored height where available, as get_centroids
+    h = read('height_c') if 'height_c' in fid.variables else depth
+    hInv = 1.0/(h + 1.0e-12)
+    hWet = (h > minimum_allowed_height)
+    xvel = xmom*hInv*hWet
+    yvel = ymom*hInv*hWet
+    return stage, depth, xmom, ymom, xvel, yvel
+
+def ComputeChezy(depth, n, m, hv, D):
+    """
+    Function to compute the Chezy coefficient from Mannings (cells with
+    n > 0) or Baptist (cells with m > 0), vectorized over all timesteps.
+    depth has shape (timesteps, N), friction parameters are the output of
+    AssignFricValue. Cells with neither are given C = 65.
+    Returns a numpy.ndarray the shape and type of depth
     """
-    Function to extract and save individual output files in binary format.
-    Inputs are the 'mydir' defined in the run script and reloaded .sww
-    values, i.e. the output of anuga.utilities.plot_utils.get_centroids()
-    """
-    # Query values: time, x, y, stage, elev, height, xmom, ymom, xvel, yvel, friction, vel, etc
-    np.save(mydir+'/data/time.npy', swwvals.time.data, allow_pickle=False)
-    np.save(mydir+'/data/topo.npy', swwvals.elev.data, allow_pickle=False)
-    np.save(mydir+'/data/x.npy', swwvals.x.data, allow_pickle=False)
-    np.save(mydir+'/data/y.npy', swwvals.y.data, allow_pickle=False)
-    np.save(mydir+'/data/xmom.npy', swwvals.xmom, allow_pickle=False)
-    np.save(mydir+'/data/ymom.npy', swwvals.ymom, allow_pickle=False)
-    np.save(mydir+'/data/xvel.npy', swwvals.xvel, allow_pickle=False)
-    np.save(mydir+'/data/yvel.npy', swwvals.yvel, allow_pickle=False)
-    np.save(mydir+'/data/depth.npy', swwvals.height, allow_pickle=False)
-    np.save(mydir+'/data/stage.npy', swwvals.stage, allow_pickle=False)
-    # Extract friction values
-    FricVal = Raster2Mesh(swwvals.x, swwvals.y, friction_loc)
-    n, m, hv, D = AssignFricValue(FricVal)
     a2 = (D*m/(2*9.81)) # Second lumped coefficient
-    chezy = np.zeros_like(swwvals.height)
-    for ii in list(range(len(swwvals.time))): 
-        idn = n>0
-        idm = m>0
-        chezy[ii,idn] = (swwvals.height[ii,idn]**(1/6))/n[idn]
-        chezy[ii,idm] = (65.**-2 + a2[idm]*1.68*np.minimum(swwvals.height[ii,idm], hv[idm]))**-0.5 + \
-                        7.8289*np.log(np.maximum(swwvals.height[ii,idm], hv[idm]) / hv[idm])
+    chezy = np.zeros_like(depth)
+    idn = n>0
+    idm = m>0
+    chezy[:,idn] = (depth[:,idn]**(1/6))/n[idn]
+    h = depth[:,idm]
+    chezy[:,idm] = (65.**-2 + a2[idm]*1.68*np.minimum(h, hv[idm]))**-0.5 + \
+                   7.8289*np.log(np.maximum(h, hv[idm]) / hv[idm])
     chezy[chezy==0] = 65.
-    np.save(mydir+'/data/chezy.npy', chezy, allow_pickle=False)
+    return chezy
+
+def CreateOutputFiles(sww_file, mydir):
+    """
+    Function to write the static output files (time, topo, x, y) and
+    create the empty time-varying .npy files in mydir/data, ready to be
+    filled by SaveOutputSlices. Returns the number of timesteps
+    """
+    fid = NetCDFFile(sww_file, netcdf_mode_r)
+    try:
+        time = np.asarray(fid.variables['time'][:])
+        x, y, elev = ReadCentroidGeometry(fid)
+    finally:
+        fid.close()
+    np.save(mydir+'/data/time.npy', time, allow_pickle=False)
+    np.save(mydir+'/data/topo.npy', elev, allow_pickle=False)
+    np.save(mydir+'/data/x.npy', x, allow_pickle=False)
+    np.save(mydir+'/data/y.npy', y, allow_pickle=False)
+    for name in output_names:
+        out = np.lib.format.open_memmap(mydir+'/data/%s.npy' % name, mode='w+',
+                                        dtype=np.float32,
+                                        shape=(len(time), len(x)))
+        del out # Only the header and file size are written here
+    # Sample the friction map once, so SaveOutputSlices reads it from the cache
+    Raster2MeshCached(x, y, friction_loc)
+    return len(time)
+
+def NpyDataOffset(fid):
+    """
+    Function to find where the values start in an open .npy file, after
+    the header. Returns the offset in bytes
+    """
+    fid.seek(0)
+    version = np.lib.format.read_magic(fid)
+    if version == (1, 0):
+        np.lib.format.read_array_header_1_0(fid)
+    else:
+        np.lib.format.read_array_header_2_0(fid)
+    return fid.tell()
+
+def TimeRanges(nt, nparts):
+    """
+    Function to split nt timesteps into nparts contiguous ranges of near
+    equal length. Returns a list of (t0, t1) pairs, t1 exclusive
+    """
+    return [(nt*ii//nparts, nt*(ii+1)//nparts) for ii in range(nparts)]
+
+def SaveOutputSlices(sww_file, mydir, t0, t1, chunk_mb=output_chunk_mb):
+    """
+    Function to fill timesteps t0 to t1 (exclusive) of the output files
+    made by CreateOutputFiles, reading the .sww in chunks of timesteps so
+    that at most about chunk_mb MB of values are held in memory.
+    Values are written at their offset in each file, so any number of
+    processes can fill disjoint time ranges of the same files at once.
+    Chezy is computed from the friction map specified in settings.py
+    """
+    fid = NetCDFFile(sww_file, netcdf_mode_r)
+    outputs = []
+    try:
+        x, y, elev = ReadCentroidGeometry(fid)
+        n, m, hv, D = AssignFricValue(Raster2MeshCached(x, y, friction_loc))
+        for name in output_names:
+            outputs.append(open(mydir+'/data/%s.npy' % name, 'r+b'))
+        offsets = [NpyDataOffset(out) for out in outputs]
+        row_bytes = 4*len(x) # One float32 value per cell
+        # Roughly 16 float32 arrays of one chunk are alive at once
+        chunk = max(1, int(chunk_mb*2**20 // (16*row_bytes + 1)))
+        for c0 in range(t0, t1, chunk):
+            c1 = min(c0 + chunk, t1)
+            values = ReadCentroidSlices(fid, elev, c0, c1)
+            values += (ComputeChezy(values[1], n, m, hv, D),)
+            for out, offset, val in zip(outputs, offsets, values):
+                out.seek(offset + c0*row_bytes)
+                out.write(np.ascontiguousarray(val, dtype=np.float32).tobytes())
+    finally:
+        for out in outputs:
+            out.close()
+        fid.close()
+    return
+
+def SaveOutputs(sww_file, mydir, chunk_mb=output_chunk_mb,
+                processes=output_processes):
+    """
+    Function to extract and save individual output files in binary format.
+    Inputs are the 'mydir' defined in the run script and the merged .sww
+    file, which is streamed in chunks of timesteps so memory use does not
+    grow with the length of the run. Values match those of
+    anuga.utilities.plot_utils.get_centroids()
+    With processes > 1 the timesteps are split across a process pool,
+    sharing the chunk_mb memory budget
+    """
+    nt = CreateOutputFiles(sww_file, mydir)
+    if processes > 1 and nt > 1:
+        import multiprocessing
+        jobs = [(sww_file, mydir, t0, t1, chunk_mb/processes)
+                for t0, t1 in TimeRanges(nt, min(processes, nt))]
+        with multiprocessing.Pool(len(jobs)) as pool:
+            pool.starmap(SaveOutputSlices, jobs)
+    else:
+        SaveOutputSlices(sww_file, mydir, 0, nt, chunk_mb)
+    return
+
+def SaveOutputsParallel(sww_file, mydir, chunk_mb=output_chunk_mb,
+                        processes=output_processes):
+    """
+    Function to save the individual output files as SaveOutputs, with the
+    timesteps split across all processors. Must be called on every
+    processor after domain.sww_merge() and before finalize().
+    chunk_mb is the memory budget of each processor. On a single
+    processor this is SaveOutputs, using a pool of processes
+    """
+    if anuga.numprocs == 1:
+        return SaveOutputs(sww_file, mydir, chunk_mb, processes)
+    if anuga.myid == 0:
+        CreateOutputFiles(sww_file, mydir)
+    anuga.barrier() # Files must exist before anyone writes to them
+    nt = len(np.load(mydir+'/data/time.npy'))
+    t0, t1 = TimeRanges(nt, anuga.numprocs)[anuga.myid]
+    if t1 > t0:
+        SaveOutputSlices(sww_file, mydir, t0, t1, chunk_mb)
+    anuga.barrier()
     return
 
-def SaveInitialConditions(swwvals, mydir, time_id=-1,
-                          name_depth=IC_depth_source,
-                          name_xmom=IC_xmom_source,
-                          name_ymom=IC_ymom_source):
+def SaveInitialConditions(sww_file, mydir, time_id=-1, IC_filename=IC_dest):
     """
     Function to extract and save a specific timestep to use for future IC
-    Inputs are reloaded .sww file and IC filenames, defaults set
-    in settings.py. Default time_id is last timestep.
+    Inputs are the .sww filename and IC filename, default set in
+    settings.py. Default time_id is last timestep.
+    Depth, xmom and ymom are saved as a float64 .npy of shape (3, N),
+    with a .json recording the source run, time and a mesh fingerprint
     """
     import shutil
-    # Replace old IC files with new ones
-    np.savetxt(name_depth, swwvals.height[time_id,:], delimiter=',')
-    np.savetxt(name_xmom, swwvals.xmom[time_id,:], delimiter=',')
-    np.savetxt(name_ymom, swwvals.ymom[time_id,:], delimiter=',')
+    fid = NetCDFFile(sww_file, netcdf_mode_r)
+    try:
+        time_id = range(len(fid.variables['time']))[time_id]
+        time = float(fid.variables['time'][time_id])
+        x, y, elev = ReadCentroidGeometry(fid)
+        stage, depth, xmom, ymom = ReadCentroidSlices(fid, elev, time_id,
+                                                      time_id+1)[:4]
+        info = MeshFingerprint(x + fid.xllcorner, y + fid.yllcorner)
+    finally:
+        fid.close()
+    info['source_run'] = os.path.basename(os.path.normpath(mydir))
+    info['time'] = time
+    # Replace old IC files with new ones, writing then renaming
+    IC_info = InitialConditionsInfo(IC_filename)
+    tmp = '%s.%d.tmp.npy' % (IC_filename[:-4], os.getpid())
+    np.save(tmp, np.array([depth[0,:], xmom[0,:], ymom[0,:]], dtype=float),
+            allow_pickle=False)
+    os.replace(tmp, IC_filename)
+    with open(IC_info + '.tmp', 'w') as f:
+        json.dump(info, f)
+    os.replace(IC_info + '.tmp', IC_info)
     # Then copy them into folder to keep a record of IC files
     newdir = os.path.join(mydir,'New_IC_Files')
     os.makedirs(newdir)
-    shutil.copy2(name_depth,os.path.join(newdir,name_depth.split(os.sep)[-1]))
-    shutil.copy2(name_xmom,os.path.join(newdir,name_xmom.split(os.sep)[-1]))
-    shutil.copy2(name_ymom,os.path.join(newdir,name_ymom.split(os.sep)[-1]))
+    shutil.copy2(IC_filename,os.path.join(newdir,os.path.basename(IC_filename)))
+    shutil.copy2(IC_info,os.path.join(newdir,os.path.basename(IC_info)))
     return
@@ -3,13 +3,19 @@ Vegetation operators
 """
 from __future__ import division, absolute_import, print_function
 import numpy as num
-from numpy import sqrt, minimum, maximum, log
+from math import sqrt, log
+from inspect import signature
+
+try:
+    from numba import njit
+    numba_available = True
+except ImportError:
+    numba_available = False
 
 # from anuga import Domain
 from anuga import Quantity
 from anuga.operators.base_operator import Operator
 
-# from math import sqrt, log
 # from anuga.config import epsilon, g
 
 # import anuga.utilities.log as log
@@ -19,6 +25,189 @@ from anuga.operators.base_operator import Operator
 # import os
 # from scipy.interpolate import NearestNDInterpolator
 
+def centroid_values(values):
+    """
+    Return the centroid array of a Quantity, or the input itself if it is
+    already a per-cell array
+    """
+    if isinstance(values, Quantity):
+        return values.centroid_values
+    return num.asarray(values, dtype=float)
+
+def class_dtype(num_classes):
+    """
+    Smallest unsigned integer type able to hold num_classes class ids
+    """
+    if num_classes <= 256:
+        return num.uint8
+    elif num_classes <= 65536:
+        return num.uint16
+    return num.int32
+
+def baptist_chezy(depth, veg_height, a1, a2, Cd, a3):
+    """
+    Exact vegetated Chezy coefficient
+    Cv = (a1 + a2*Cd*min(h,hv))^-0.5 + a3*ln(max(h,hv)/hv)
+    """
+    return ((a1 + a2*Cd*num.minimum(depth, veg_height))**-0.5
+            + a3*num.log(num.maximum(depth, veg_height)/veg_height))
+
+def chezy_table_rows(class_height, class_a1, class_a2, Cd, a3, dz, num_samples,
+                     vegetated):
+    """
+    Sample Cv(h) at h = 0, dz, ..., num_samples*dz for each class, one row
+    per class. Rows of classes that are not vegetated are left at zero.
+    vegetated must be the criterion of the active set (density > 0), so
+    that every active cell has a row, including those with a2 == 0.
+    """
+    rows = num.zeros((len(class_height), num_samples + 1))
+    depth = num.arange(num_samples + 1)*dz
+    for c in num.flatnonzero(vegetated):
+        rows[c] = baptist_chezy(depth, class_height[c], class_a1[c],
+                                class_a2[c], Cd, a3)
+    return rows
+
+def chezy_table_error(rows, class_height, class_a1, class_a2, Cd, a3, dz,
+                      vegetated, min_depth=0.0):
+    """
+    Maximum relative error of linear interpolation in the table rows of
+    the vegetated classes, checked against the exact formula inside every
+    table interval deeper than min_depth
+    """
+    error = 0.0
+    num_samples = rows.shape[1] - 1
+    j = num.arange(num_samples)
+    j = j[(j + 1)*dz > min_depth]
+    for c in num.flatnonzero(vegetated):
+        for frac in (0.25, 0.5, 0.75):
+            depth = (j + frac)*dz
+            exact = baptist_chezy(depth, class_height[c], class_a1[c],
+                                  class_a2[c], Cd, a3)
+            table = rows[c, j] + frac*(rows[c, j+1] - rows[c, j])
+            error = max(error, num.max(num.abs(table - exact)/exact))
+    return error
+
+#===============================================================================
+# Compiled kernel
+#===============================================================================
+def baptist_drag_loop(stage_c, elev_c, xmom_c, ymom_c, veg_ind, active_w,
+                      hv_w, a1_w, a2_w, Cd, a3, g, dt, wet_depth,
+                      semi_implicit):
+    """
+    Single pass Baptist drag update over the vegetated cells veg_ind.
+    Momentum is read and updated in place through veg_ind, with no
+    gathered copies. active_w, hv_w, a1_w and a2_w are given
+    per vegetated cell, i.e. in the same order as veg_ind, and cells that
+    are not active, dry or still are skipped. The log term is only
+    evaluated for submerged vegetation. If semi_implicit,
+    uh is updated as uh/(1 + factor) rather than uh - factor*uh.
+    """
+    for k in range(len(veg_ind)):
+        i = veg_ind[k]
+        h = stage_c[i] - elev_c[i]
+        if h <= wet_depth or not active_w[k]:
+            continue
+
+        uh = xmom_c[i]
+        vh = ymom_c[i]
+        qcell = sqrt(uh*uh + vh*vh)
+        if qcell == 0.0:
+            continue # No drag on still water
+
+        # The log term is zero unless the vegetation is submerged
+        hv = hv_w[k]
+        if h < hv:
+            Cv = 1.0/sqrt(a1_w[k] + a2_w[k]*Cd*h)
+        else:
+            Cv = 1.0/sqrt(a1_w[k] + a2_w[k]*Cd*hv) + a3*log(h/hv)
+        factor = g*qcell*dt/(Cv*Cv*h*h + 1e-6)
+
+        if semi_implicit:
+            xmom_c[i] = uh/(1.0 + factor)
+            ymom_c[i] = vh/(1.0 + factor)
+        else:
+            xmom_c[i] = uh - factor*uh
+            ymom_c[i] = vh - factor*vh
+
+def baptist_drag_table_loop(stage_c, elev_c, xmom_c, ymom_c, veg_ind,
+                            active_w, hv_w, a1_w, a2_w, Cd, a3, g, dt,
+                            wet_depth, semi_implicit, table, row_w, inv_dz,
+                            num_samples):
+    """
+    As baptist_drag_loop, but Cv is interpolated from the flattened per class
+    table (row_w holds each cell's row offset). Depths beyond the table use
+    the exact formula.
+    """
+    for k in range(len(veg_ind)):
+        i = veg_ind[k]
+        h = stage_c[i] - elev_c[i]
+        if h <= wet_depth or not active_w[k]:
+            continue
+
+        uh = xmom_c[i]
+        vh = ymom_c[i]
+        qcell = sqrt(uh*uh + vh*vh)
+        if qcell == 0.0:
+            continue # No drag on still water
+
+        x = h*inv_dz
+        if x < num_samples:
+            j = int(x)
+            frac = x - j
+            j += row_w[k]
+            Cv = table[j] + frac*(table[j+1] - table[j])
+        else:
+            hv = hv_w[k]
+            if h < hv:
+                Cv = 1.0/sqrt(a1_w[k] + a2_w[k]*Cd*h)
+            else:
+                Cv = 1.0/sqrt(a1_w[k] + a2_w[k]*Cd*hv) + a3*log(h/hv)
+        factor = g*qcell*dt/(Cv*Cv*h*h + 1e-6)
+
+        if semi_implicit:
+            xmom_c[i] = uh/(1.0 + factor)
+            ymom_c[i] = vh/(1.0 + factor)
+        else:
+            xmom_c[i] = uh - factor*uh
+            ymom_c[i] = vh - factor*vh
+
+def baptist_diffusivity_loop(stage_c, elev_c, xmom_c, ymom_c, veg_ind,
+                             active_w, diameter_w, spacing_w, ad_w, sqrt_k_w, adD_w,
+                             wet_depth, diffusivity_c):
+    """
+    Nepf (1999) vegetated diffusivity over the vegetated cells veg_ind,
+    written into diffusivity_c (zero in dry or inactive cells). See
+    Baptist_operator.calculate_diffusivity.
+    """
+    for k in range(len(veg_ind)):
+        i = veg_ind[k]
+        h = stage_c[i] - elev_c[i]
+        if h <= wet_depth or not active_w[k]:
+            diffusivity_c[i] = 0.0
+            continue
+
+        D = diameter_w[k]
+        ad = ad_w[k]
+        if ad > 0.01:
+            mix_length = D
+        elif spacing_w[k] > h:
+            mix_length = h
+        else:
+            ad_deltaS = (D/h)**2
+            mix_length = h + (D - h)*(ad - ad_deltaS)/max(0.01 - ad_deltaS, 1e-12)
+
+        velocity = sqrt(xmom_c[i]**2 + ymom_c[i]**2)/h
+        diffusivity_c[i] = velocity*(sqrt_k_w[k]*mix_length + adD_w[k])
+
+if numba_available:
+    baptist_drag_kernel = njit(cache=True, nogil=True)(baptist_drag_loop)
+    baptist_drag_table_kernel = njit(cache=True, nogil=True)(baptist_drag_table_loop)
+    baptist_diffusivity_kernel = njit(cache=True, nogil=True)(baptist_diffusivity_loop)
+else:
+    baptist_drag_kernel = None
+    baptist_drag_table_kernel = None
+    baptist_diffusivity_kernel = None
+
 #===============================================================================
 # Vegetation operator applying drag to the flow
 #===============================================================================
@@ -39,15 +228,28 @@ class Baptist_operator(Operator):
     
     Operator uses explicit form to update velocities, according to:
     d/dt(uh) = -g*uh*sqrt(uh^2 + vh^2)/(Cv^2*h^2)
+
+    or, with scheme='semi_implicit', the drag is treated implicitly in uh
+    (as in manning_friction_implicit), which is unconditionally stable:
+    uh_new = uh / (1 + dt*g*sqrt(uh^2 + vh^2)/(Cv^2*h^2))
     """
 
+    schemes = ['explicit', 'semi_implicit']
+
     def __init__(self, 
                  domain, 
                  veg_diameter=None,
                  veg_density=None,
                  veg_height=None,
                  bed_friction=65.0,
+                 veg_class=None,
+                 store_quantities=False,
                  use_diffusivity=False,
+                 use_compiled=True,
+                 scheme='explicit',
+                 use_lookup_table=False,
+                 table_max_depth=20.0,
+                 table_tolerance=1.0e-3,
                  description = None,
                  label = None,
                  logging = False,
@@ -85,9 +287,52 @@ class Baptist_operator(Operator):
                 one constant value to be applied everywhere, or an array giving
                 one value per cell centroid.
 
+            veg_class : `np.ndarray`, optional
+                Vegetation class of each cell centroid, as integers starting
+                at 0 (e.g. uint8). If given, veg_diameter, veg_density,
+                veg_height and bed_friction are instead tables with one
+                value per class (or a single value for all classes), and
+                only the class array and the tables are stored.
+
+            store_quantities : `bool`, optional
+                Register veg_diameter, veg_density and veg_height as domain
+                quantities, e.g. to write them to output. Default is False,
+                which saves the memory of three full quantities.
+
             use_diffusivity : `bool`
                 Indicates whether to turn on vegetated kinematic viscosity, or
-                to just use friction. Default is true.
+                to just use friction. If True, the diffusivity quantity is
+                updated on the vegetated cells following Nepf (1999) and used
+                by the kinematic viscosity operator. Default is False.
+                Needs the Domain of anuga_tools/shallow_water_domain.py, whose
+                set_use_kinematic_viscosity takes the diffusivity quantity.
+                If False, the kinematic viscosity operator is turned off.
+
+            use_compiled : `bool`, optional
+                Use the compiled (numba) single pass kernel for the drag
+                update when numba is available. Falls back to the numpy
+                implementation otherwise. Default is True.
+
+            scheme : `str`, optional
+                Time discretisation of the drag term, either 'explicit'
+                (default) or 'semi_implicit'. The semi-implicit update
+                cannot overshoot and change the sign of the momentum in
+                shallow, densely vegetated cells.
+
+            use_lookup_table : `bool`, optional
+                Replace the power and log in the Chezy formula by linear
+                interpolation in a table of Cv(h) per vegetation class.
+                Default is False.
+
+            table_max_depth : `float`, optional
+                Depth [m] covered by the lookup table. Deeper cells use the
+                exact formula. Default is 20.
+
+            table_tolerance : `float`, optional
+                Maximum relative error in Cv allowed for the lookup table.
+                The table spacing is refined until the interpolation error,
+                checked against the exact formula at the depths where drag
+                is applied, is within this bound. Default is 1e-3.
 
         **Outputs** :
 
@@ -98,88 +343,449 @@ class Baptist_operator(Operator):
         """
         Operator.__init__(self, domain, description, label, logging, verbose)
 
+        if scheme not in self.schemes:
+            msg = 'Unknown scheme. \nPossible choices are:\n'+ \
+            ', '.join(self.schemes)+'.'
+            raise Exception(msg)
+        self.scheme = scheme
+        self.semi_implicit = (scheme == 'semi_implicit')
+
         #-----------------------------------------------------
         # Pull domain information
-        self.depth = self.stage_c - self.elev_c
         self.g = self.domain.g
+        self.num_cells = len(self.domain)
 
         #-----------------------------------------------------
         # Populate some variables
-        if veg_diameter is None:
-            try:
-                self.veg_diameter = self.domain.get_quantity('veg_diameter')
-            except:
-                raise ValueError('Vegetation diameter not defined')
+        if veg_class is None:
+            # Per cell values, reduced to the distinct combinations
+            D = self.get_cell_parameter(veg_diameter, 'veg_diameter',
+                                        'Vegetation diameter not defined')
+            m = self.get_cell_parameter(veg_density, 'veg_density',
+                                        'Vegetation spacing not defined')
+            hv = self.get_cell_parameter(veg_height, 'veg_height',
+                                         'Vegetation height not defined')
+            Cb = self.get_cell_parameter(bed_friction, None,
+                                         'Bed friction not defined')
+            tables, veg_class = num.unique(num.column_stack((D, m, hv, Cb)),
+                                           axis=0, return_inverse=True)
+            veg_class = veg_class.reshape(-1).astype(class_dtype(len(tables)))
+            self.set_class_parameters(veg_class, *tables.T)
         else:
-            if isinstance(veg_diameter, float):
-                veg_diameter = num.ones_like(self.depth, dtype=float)*veg_diameter
-            self.veg_diameter = veg_diameter
-            Quantity(domain, name='veg_diameter', register=True)
-            self.domain.quantities['veg_diameter'].\
-                set_values(self.veg_diameter, location = 'centroids')
-
-        if veg_density is None:
-            try:
-                self.veg_density = self.domain.get_quantity('veg_density')
-            except:
-                raise ValueError('Vegetation spacing not defined')
-        else:
-            if isinstance(veg_density, float):
-                veg_density = num.ones_like(self.depth, dtype=float)*veg_density
-            self.veg_density = veg_density
-            Quantity(domain, name='veg_density', register=True)
-            self.domain.quantities['veg_density'].\
-                set_values(self.veg_density, location = 'centroids')
-
-        if veg_height is None:
-            try:
-                self.veg_height = self.domain.get_quantity('veg_height')
-            except:
-                raise ValueError('Vegetation height not defined')
-        else:
-            if isinstance(veg_height, float):
-                veg_height = num.ones_like(self.depth, dtype=float)*veg_height
-            self.veg_height = veg_height
-            Quantity(domain, name='veg_height', register=True)
-            self.domain.quantities['veg_height'].\
-                set_values(self.veg_height, location = 'centroids')
+            self.set_class_parameters(veg_class, veg_diameter, veg_density,
+                                      veg_height, bed_friction)
+
+        if store_quantities:
+            for name, table in [('veg_diameter', self.class_diameter),
+                                ('veg_density', self.class_density),
+                                ('veg_height', self.class_height)]:
+                if name not in self.domain.quantities:
+                    Quantity(domain, name=name, register=True)
+                self.domain.quantities[name].\
+                    set_values(table[self.veg_class], location = 'centroids')
 
         self.use_diffusivity = use_diffusivity
+        self.use_compiled = use_compiled and numba_available
         if self.use_diffusivity:
-            self.diffusivity = num.zeros((self.num_cells,))
-            self.mix_length = num.zeros((self.num_cells,))
-
             try:
                 diff = self.domain.get_quantity('diffusivity')
             except:
                 Quantity(domain, name='diffusivity', register=True)
+            self.diffusivity_c = \
+                self.domain.quantities['diffusivity'].centroid_values
 
-        self.domain.set_use_kinematic_viscosity(self.use_diffusivity)
+            # Stock anuga's Domain always uses the water height as diffusivity
+            if 'diffusivity' not in \
+                    signature(self.domain.set_use_kinematic_viscosity).parameters:
+                msg = ('use_diffusivity needs the Domain of '
+                       'anuga_tools/shallow_water_domain.py, whose '
+                       'set_use_kinematic_viscosity takes a diffusivity')
+                raise Exception(msg)
+            self.domain.set_use_kinematic_viscosity(True,
+                                                    diffusivity='diffusivity')
+        else:
+            self.domain.set_use_kinematic_viscosity(False)
 
         #----------------------------------------------------
         # Start populating/computing coefficients
-        self.ind = (self.veg_density > 0) # Vegetated indices
-
         self.Cd = 1.68 # Assumed for now, replace later with equation
-        if isinstance(bed_friction, float): # Check if Cb is const or array
-            self.bed_friction = num.ones_like(self.depth, dtype=float)*bed_friction
-        self.a1 = self.bed_friction**-2 # First lumped coefficient
+        self.class_a1 = self.class_bed_friction**-2 # First lumped coefficient
 
-        self.a2 = (self.veg_diameter * self.veg_density / (2*self.g)) # Second lumped coefficient
+        self.class_a2 = (self.class_diameter * self.class_density / (2*self.g)) # Second lumped coefficient
 
         self.a3 = 7.8289 # Third lumped coefficient
 
+        self.wet_depth = 0.01 # Depth below which no drag is applied
+
+        self.store_quantities = store_quantities
+        self.use_lookup_table = use_lookup_table
+        self.table_max_depth = table_max_depth
+        self.table_tolerance = table_tolerance
+        self.veg_series = None
+
+        self.set_active_classes(self.class_density > 0)
+
+
+
+    def get_cell_parameter(self, value, name, msg):
+        """
+        Return a per cell array for a parameter given as a constant, as an
+        array of centroid values, or as None to use the existing quantity
+        called name
+        """
+        if value is None:
+            try:
+                value = self.domain.get_quantity(name)
+            except:
+                raise ValueError(msg)
+        if num.ndim(centroid_values(value)) == 0:
+            return num.ones(self.num_cells, dtype=float)*float(value)
+        return centroid_values(value)
+
+
+
+    def set_class_parameters(self, veg_class, veg_diameter, veg_density,
+                             veg_height, bed_friction):
+        """
+        Store the per cell class array and the per class parameter tables.
+        Each parameter can be a table with one value per class or a single
+        value for all classes.
+        """
+        veg_class = num.asarray(veg_class)
+        tables = [num.atleast_1d(num.asarray(p, dtype=float))
+                  for p in (veg_diameter, veg_density, veg_height, bed_friction)]
+        num_classes = max(len(t) for t in tables)
+        for ii, t in enumerate(tables):
+            if len(t) == 1:
+                tables[ii] = num.repeat(t, num_classes)
+            elif len(t) != num_classes:
+                raise ValueError('Vegetation parameter tables must all have '
+                                 'the same number of classes')
+
+        if len(veg_class) != self.num_cells:
+            raise ValueError('veg_class must give one class per cell')
+        if veg_class.min() < 0 or veg_class.max() >= num_classes:
+            raise ValueError('veg_class contains class ids outside 0-%d'
+                             % (num_classes - 1))
+
+        self.num_classes = num_classes
+        self.veg_class = veg_class.astype(class_dtype(num_classes))
+        (self.class_diameter, self.class_density,
+         self.class_height, self.class_bed_friction) = tables
+
+
+
+    def set_active_classes(self, active_classes):
+        """
+        Build the compact active set, the cells whose class is in
+        active_classes, with the per cell coefficients and the work arrays.
+        Vegetation does not move, so this is done once (and again only if
+        a vegetation series makes more classes vegetated) and every
+        per-step operation works on this subset.
+        """
+        self.active_classes = num.asarray(active_classes, dtype=bool)
+        self.veg_ind = num.flatnonzero(self.active_classes[self.veg_class])
+        self.veg_ind = self.veg_ind.astype(num.int32)
+        self.num_veg = len(self.veg_ind)
+        self.veg_class_w = self.veg_class[self.veg_ind]
+
+        # Positions in the active set of the cells of each class
+        order = num.argsort(self.veg_class_w, kind='stable')
+        bounds = num.searchsorted(self.veg_class_w[order],
+                                  num.arange(self.num_classes + 1))
+        self.class_cells_w = [order[bounds[c]:bounds[c+1]]
+                              for c in range(self.num_classes)]
+
+        # Per cell coefficients, filled in per class
+        self.hv_w = num.ones(self.num_veg)
+        self.a1_w = num.zeros(self.num_veg)
+        self.a2_w = num.zeros(self.num_veg)
+        self.active_w = num.zeros(self.num_veg, dtype=bool)
+        if self.use_diffusivity:
+            self.diameter_w = num.zeros(self.num_veg)
+            self.spacing_w = num.zeros(self.num_veg)
+            self.ad_w = num.zeros(self.num_veg)
+            self.sqrt_k_w = num.zeros(self.num_veg)
+            self.adD_w = num.zeros(self.num_veg)
+        self.update_class_coefficients(num.arange(self.num_classes))
+
+        if self.use_lookup_table:
+            self.set_chezy_table(self.table_max_depth, self.table_tolerance)
+
+        # Work arrays, reused on every call
+        self.depth_w = num.zeros(self.num_veg)
+        self.xmom_w = num.zeros(self.num_veg)
+        self.ymom_w = num.zeros(self.num_veg)
+        self.qcell_w = num.zeros(self.num_veg)
+        self.Cv_w = num.zeros(self.num_veg)
+        self.work_w = num.zeros(self.num_veg)
+        self.wet_w = num.zeros(self.num_veg, dtype=bool)
+        if self.use_lookup_table:
+            self.table_w = num.zeros(self.num_veg)
+            self.tabind_w = num.zeros(self.num_veg, dtype=num.intp)
+        if self.use_diffusivity:
+            self.velocity_w = num.zeros(self.num_veg)
+            self.mix_length_w = num.zeros(self.num_veg)
+            self.diffusivity_w = num.zeros(self.num_veg)
+            self.mask_w = num.zeros(self.num_veg, dtype=bool)
+
+
+
+    def update_class_coefficients(self, classes):
+        """
+        Recompute the lumped coefficients of the given classes from the
+        class tables and copy them to the cells of those classes in the
+        active set. Classes without vegetation at present (density 0) are
+        switched off through active_w and given finite placeholder values.
+        """
+        classes = num.asarray(classes, dtype=int)
+        self.class_a1[classes] = self.class_bed_friction[classes]**-2
+        self.class_a2[classes] = (self.class_diameter[classes] *
+                                  self.class_density[classes] / (2*self.g))
+        if self.use_diffusivity:
+            self.set_diffusivity_parameters()
+
+        for c in classes:
+            cells = self.class_cells_w[c]
+            if len(cells) == 0:
+                continue
+            vegetated = self.class_density[c] > 0
+            self.active_w[cells] = vegetated
+            self.hv_w[cells] = self.class_height[c] if vegetated else 1.0
+            self.a1_w[cells] = self.class_a1[c]
+            self.a2_w[cells] = self.class_a2[c] if vegetated else 0.0
+            if self.use_diffusivity:
+                self.diameter_w[cells] = self.class_diameter[c]
+                self.spacing_w[cells] = self.class_spacing[c]
+                self.ad_w[cells] = self.class_ad[c]
+                self.sqrt_k_w[cells] = self.class_sqrt_k[c]
+                self.adD_w[cells] = self.class_adD[c]
+
+
+
+    def set_vegetation_series(self, times, veg_diameter=None, veg_density=None,
+                              veg_height=None, refresh_interval=86400.0):
+        """
+        Attach per class time series of the vegetation parameters, e.g. for
+        seasonal growth and dieback.
+
+        **Inputs** :
+
+            times : `np.ndarray`
+                Increasing model times [s] of the samples
+
+            veg_diameter, veg_density, veg_height : `np.ndarray`, optional
+                Samples of shape (len(times), num_classes). Linearly
+                interpolated in time and held constant outside times. If
+                None, the parameter stays constant.
+
+            refresh_interval : `float`, optional
+                Model time [s] between updates of the coefficients. Only the
+                classes whose parameters changed are recomputed. Default is
+                one day.
+        """
+        times = num.asarray(times, dtype=float)
+        if times.ndim != 1 or len(times) == 0 or num.any(num.diff(times) <= 0):
+            raise ValueError('times must be a non-empty increasing 1D array')
+
+        series = {}
+        for name, values in [('diameter', veg_diameter),
+                             ('density', veg_density),
+                             ('height', veg_height)]:
+            if values is None:
+                continue
+            values = num.asarray(values, dtype=float)
+            if values.shape != (len(times), self.num_classes):
+                msg = ('veg_%s series must have shape (%d, %d), got %s'
+                       % (name, len(times), self.num_classes, values.shape))
+                raise ValueError(msg)
+            series[name] = values
+
+        self.veg_series_times = times
+        self.veg_series = series
+        self.refresh_interval = float(refresh_interval)
+
+        # Cells of classes that are vegetated at any time join the active set
+        active_classes = self.active_classes.copy()
+        if 'density' in series:
+            active_classes |= num.any(series['density'] > 0, axis=0)
+        if num.any(active_classes != self.active_classes):
+            self.set_active_classes(active_classes)
+
+        self.refresh_vegetation()
+
+
+
+    def refresh_vegetation(self, time=None):
+        """
+        Interpolate the vegetation series to time (default the domain time)
+        and update the coefficients of the classes that changed
+        """
+        if time is None:
+            time = self.get_time()
+        times = self.veg_series_times
+
+        # Bracketing samples and weight, clamped to the ends of the series
+        j = num.searchsorted(times, time, side='right') - 1
+        j = min(max(j, 0), max(len(times) - 2, 0))
+        if len(times) > 1:
+            w = min(max((time - times[j])/(times[j+1] - times[j]), 0.0), 1.0)
+        else:
+            w = 0.0
+
+        changed = num.zeros(self.num_classes, dtype=bool)
+        for name, values in self.veg_series.items():
+            if len(times) > 1:
+                new = values[j] + w*(values[j+1] - values[j])
+            else:
+                new = values[0]
+            table = getattr(self, 'class_' + name)
+            changed |= (new != table)
+            table[:] = new
+        changed = num.flatnonzero(changed)
+
+        if len(changed) > 0:
+            self.update_class_coefficients(changed)
+            if self.use_lookup_table:
+                self.update_chezy_table(changed)
+            if self.store_quantities:
+                for name, table in [('veg_diameter', self.class_diameter),
+                                    ('veg_density', self.class_density),
+                                    ('veg_height', self.class_height)]:
+                    self.domain.quantities[name].\
+                        set_values(table[self.veg_class], location = 'centroids')
+
+        self.next_refresh = time + self.refresh_interval
+
+
+
+    def update_chezy_table(self, classes):
+        """
+        Recompute the lookup table rows of the given classes. The whole table
+        is rebuilt if the new rows do not meet the tolerance.
+        """
+        rows = self.chezy_table.reshape(self.num_classes, -1)
+        rows[classes] = chezy_table_rows(self.class_height[classes],
+                                         self.class_a1[classes],
+                                         self.class_a2[classes],
+                                         self.Cd, self.a3, self.table_dz,
+                                         self.table_num_samples,
+                                         self.class_density[classes] > 0)
+        error = chezy_table_error(rows[classes], self.class_height[classes],
+                                  self.class_a1[classes],
+                                  self.class_a2[classes], self.Cd, self.a3,
+                                  self.table_dz, self.class_density[classes] > 0,
+                                  self.wet_depth)
+        if error > self.table_tolerance:
+            self.set_chezy_table(self.table_max_depth, self.table_tolerance)
+        else:
+            self.table_error = max(self.table_error, error)
+
+
+
+    def set_chezy_table(self, max_depth, tolerance, dz=0.01):
+        """
+        Build the per class Cv(h) lookup table over 0 <= h <= max_depth.
+        Starting from spacing dz, the spacing is halved until the linear
+        interpolation error is within tolerance.
+        """
+        max_samples = 2**20
+        while True:
+            num_samples = int(num.ceil(max_depth/dz))
+            rows = chezy_table_rows(self.class_height, self.class_a1,
+                                    self.class_a2, self.Cd, self.a3,
+                                    dz, num_samples, self.class_density > 0)
+            error = chezy_table_error(rows, self.class_height, self.class_a1,
+                                      self.class_a2, self.Cd, self.a3, dz,
+                                      self.class_density > 0, self.wet_depth)
+            if error <= tolerance:
+                break
+            if 2*num_samples > max_samples:
+                msg = ('Chezy lookup table cannot reach tolerance %g '
+                       '(error %g with %d samples)' % (tolerance, error,
+                                                       num_samples))
+                raise ValueError(msg)
+            dz = dz/2.
+
+        self.table_dz = dz
+        self.table_inv_dz = 1.0/dz
+        self.table_num_samples = num_samples
+        self.table_max_depth = num_samples*dz
+        self.table_error = error
+        self.chezy_table = rows.reshape(-1)
+        # Offset of each vegetated cell's row in the flattened table
+        self.row_w = self.veg_class_w.astype(num.intp)*(num_samples + 1)
+
+
+
+    def set_diffusivity_parameters(self):
+        """
+        Per class constants of the Nepf (1999) diffusivity. With ad = m*D^2
+        the solid volume fraction and s = m^-0.5 the stem spacing, the
+        turbulent kinetic energy is k = ((1 - ad)*Cb + (Cd*ad)^0.66)*U^2,
+        so sqrt(k) = sqrt_k*U.
+        """
+        Cb = 0.001 # Bed drag coefficient
+        veg = self.class_density > 0
+        self.class_ad = self.class_density*self.class_diameter**2
+        self.class_spacing = num.zeros(self.num_classes)
+        self.class_spacing[veg] = self.class_density[veg]**-0.5
+        self.class_veg_Cd = self.calculate_drag_coefficient(self.class_ad)
+        self.class_sqrt_k = num.sqrt((1 - self.class_ad)*Cb +
+                                     (self.class_veg_Cd*self.class_ad)**0.66)
+        self.class_adD = self.class_ad*self.class_diameter
+
 
 
     def __call__(self):
         """
         Apply vegetation drag according to veg_diameter and veg_density quantities
         """
+        if self.veg_series is not None and self.get_time() >= self.next_refresh:
+            self.refresh_vegetation()
+
+        if self.num_veg == 0:
+            return
+
         # Get the timestep for explicit update
         self.dt = self.get_timestep()
-        
-        self.depth = self.stage_c - self.elev_c
-        self.ind = (self.veg_density > 0) & (self.depth > 0.01) # Update indices
+
+        if self.use_compiled:
+            if self.use_diffusivity:
+                # Diffusivity from the flow before the drag update
+                baptist_diffusivity_kernel(self.stage_c, self.elev_c,
+                                           self.xmom_c, self.ymom_c,
+                                           self.veg_ind, self.active_w,
+                                           self.diameter_w,
+                                           self.spacing_w, self.ad_w,
+                                           self.sqrt_k_w, self.adD_w,
+                                           self.wet_depth, self.diffusivity_c)
+            if self.use_lookup_table:
+                baptist_drag_table_kernel(self.stage_c, self.elev_c,
+                                          self.xmom_c, self.ymom_c, self.veg_ind,
+                                          self.active_w, self.hv_w,
+                                          self.a1_w, self.a2_w,
+                                          self.Cd, self.a3, self.g, self.dt,
+                                          self.wet_depth, self.semi_implicit,
+                                          self.chezy_table, self.row_w,
+                                          self.table_inv_dz,
+                                          self.table_num_samples)
+            else:
+                baptist_drag_kernel(self.stage_c, self.elev_c,
+                                    self.xmom_c, self.ymom_c, self.veg_ind,
+                                    self.active_w, self.hv_w,
+                                    self.a1_w, self.a2_w,
+                                    self.Cd, self.a3, self.g, self.dt,
+                                    self.wet_depth, self.semi_implicit)
+            return
+
+        # Depth on the vegetated subset only
+        num.take(self.stage_c, self.veg_ind, out=self.depth_w)
+        num.take(self.elev_c, self.veg_ind, out=self.work_w)
+        num.subtract(self.depth_w, self.work_w, out=self.depth_w)
+        num.greater(self.depth_w, self.wet_depth, out=self.wet_w) # Update wet cells
+        num.logical_and(self.wet_w, self.active_w, out=self.wet_w)
+        num.maximum(self.depth_w, 0.0, out=self.depth_w) # Keep dry cells finite
 
         self.update_quantities()
         
@@ -191,90 +797,225 @@ class Baptist_operator(Operator):
         and update momentum quantities
         """
     
-        if sum(self.ind)>0:
-            # Cut down some variables to just vegetated areas
-            self.depth_w = self.depth[self.ind]
-            hv_w = self.veg_height[self.ind]
-            Cv_w = num.zeros_like(self.depth_w) # Vegetated Chezy
-            a1_w = self.a1[self.ind]
-            a2_w = self.a2[self.ind]
-            xmom_w = self.xmom_c[self.ind]
-            ymom_w = self.ymom_c[self.ind]
-                    
+        if not self.wet_w.any():
             if self.use_diffusivity:
-                self.mix_length[:] = 0
-                self.diffusivity[:] = 0
-                self.calculate_diffusivity()
+                num.put(self.diffusivity_c, self.veg_ind, 0.0)
+            return
+
+        depth_w = self.depth_w
+        xmom_w = self.xmom_w
+        ymom_w = self.ymom_w
+        qcell_w = self.qcell_w
+        Cv_w = self.Cv_w
+        work_w = self.work_w
+
+        num.take(self.xmom_c, self.veg_ind, out=xmom_w)
+        num.take(self.ymom_c, self.veg_ind, out=ymom_w)
+
+        # calculate discharge in the cell
+        num.multiply(xmom_w, xmom_w, out=qcell_w)
+        num.multiply(ymom_w, ymom_w, out=work_w)
+        num.add(qcell_w, work_w, out=qcell_w)
+        num.sqrt(qcell_w, out=qcell_w)
+
+        if self.use_diffusivity:
+            self.calculate_diffusivity()
 
-            # calculate discharge in the cell
-            qcell_w = sqrt(xmom_w*xmom_w + ymom_w*ymom_w)
+        # Calculate Chezy
+        if self.use_lookup_table:
+            self.interpolate_chezy()
+        else:
+            self.calculate_chezy()
 
-            # Calculate Chezy
-            Cv_w = (a1_w + a2_w * self.Cd * minimum(self.depth_w, hv_w))**-0.5 + self.a3 * log(maximum(self.depth_w, hv_w) / hv_w)
+        # Friction slope factor g*|q|*dt/(Cv^2*h^2), zero in dry cells
+        num.multiply(Cv_w, depth_w, out=work_w)
+        num.multiply(work_w, work_w, out=work_w)
+        num.add(work_w, 1e-6, out=work_w)
+        num.divide(qcell_w, work_w, out=work_w)
+        num.multiply(work_w, self.g * self.dt, out=work_w)
+        num.multiply(work_w, self.wet_w, out=work_w)
 
-            # Compute friction slope
-            Sf_x = self.g * xmom_w * qcell_w / (Cv_w**2 * self.depth_w**2 + 1e-6)
-            Sf_y = self.g * ymom_w * qcell_w / (Cv_w**2 * self.depth_w**2 + 1e-6)
+        if self.semi_implicit:
+            # uh/(1 + Sf_x*dt/uh), vh/(1 + Sf_y*dt/vh)
+            num.add(work_w, 1.0, out=work_w)
+            num.divide(xmom_w, work_w, out=xmom_w)
+            num.divide(ymom_w, work_w, out=ymom_w)
+        else:
+            # uh - Sf_x*dt, vh - Sf_y*dt
+            num.multiply(work_w, xmom_w, out=qcell_w)
+            num.subtract(xmom_w, qcell_w, out=xmom_w)
+            num.multiply(work_w, ymom_w, out=qcell_w)
+            num.subtract(ymom_w, qcell_w, out=ymom_w)
 
-            self.xmom_c[self.ind] = xmom_w - Sf_x * self.dt
-            self.ymom_c[self.ind] = ymom_w - Sf_y * self.dt
+        num.put(self.xmom_c, self.veg_ind, xmom_w)
+        num.put(self.ymom_c, self.veg_ind, ymom_w)
 
 
 
-    def calculate_drag_coefficient(self):
+    def calculate_chezy(self):
+        """
+        Evaluate the vegetated Chezy coefficient on the vegetated cells,
+        Cv = (a1 + a2*Cd*min(h,hv))^-0.5 + a3*ln(max(h,hv)/hv)
+        """
+        depth_w = self.depth_w
+        Cv_w = self.Cv_w
+        work_w = self.work_w
+
+        num.minimum(depth_w, self.hv_w, out=Cv_w)
+        num.multiply(Cv_w, self.Cd, out=Cv_w)
+        num.multiply(Cv_w, self.a2_w, out=Cv_w)
+        num.add(Cv_w, self.a1_w, out=Cv_w)
+        num.power(Cv_w, -0.5, out=Cv_w)
+        num.maximum(depth_w, self.hv_w, out=work_w)
+        num.divide(work_w, self.hv_w, out=work_w)
+        num.log(work_w, out=work_w)
+        num.multiply(work_w, self.a3, out=work_w)
+        num.add(Cv_w, work_w, out=Cv_w)
+
+
+
+    def interpolate_chezy(self):
+        """
+        Interpolate the vegetated Chezy coefficient from the per class
+        lookup table. Cells deeper than the table use the exact formula.
+        """
+        x_w = self.work_w
+        ind_w = self.tabind_w
+        Cv_w = self.Cv_w
+        table_w = self.table_w
+
+        # Fractional sample position, integer sample and weight
+        num.multiply(self.depth_w, self.table_inv_dz, out=x_w)
+        num.minimum(x_w, self.table_num_samples, out=x_w)
+        num.floor(x_w, out=table_w)
+        num.minimum(table_w, self.table_num_samples - 1, out=table_w)
+        num.subtract(x_w, table_w, out=x_w)
+        num.copyto(ind_w, table_w, casting='unsafe')
+        num.add(ind_w, self.row_w, out=ind_w)
+
+        # Cv = T[j] + frac*(T[j+1] - T[j])
+        num.take(self.chezy_table, ind_w, out=Cv_w)
+        num.add(ind_w, 1, out=ind_w)
+        num.take(self.chezy_table, ind_w, out=table_w)
+        num.subtract(table_w, Cv_w, out=table_w)
+        num.multiply(table_w, x_w, out=table_w)
+        num.add(Cv_w, table_w, out=Cv_w)
+
+        deep = self.depth_w > self.table_max_depth
+        if deep.any():
+            Cv_w[deep] = baptist_chezy(self.depth_w[deep], self.hv_w[deep],
+                                       self.a1_w[deep], self.a2_w[deep],
+                                       self.Cd, self.a3)
+
+
+
+    def calculate_drag_coefficient(self, ad):
         """
         Calculate the drag coefficient Cd as a function of ad using
         the curve fitted to Figure 6 in Nepf (1999)
         """
-        
-        self.Cd = (56.11 * self.ad**2
-                   - 15.28 * self.ad
+        ad = num.asarray(ad, dtype=float)
+        Cd = num.full(ad.shape, 1.2)
+        ind = ad >= 0.006
+        Cd[ind] = (56.11 * ad[ind]**2
+                   - 15.28 * ad[ind]
                    + 1.3
-                   - 0.0005465 / self.ad)
-        self.Cd[self.ad < 0.006] = 1.2
-        
-        self.Cd_veg = 0.5 * self.Cd * self.alpha
-        
+                   - 0.0005465 / ad[ind])
+        return Cd
+
+
 
-        
     def calculate_diffusivity(self):
         """
         Calculates a value for the quantity diffusivity for use with
-        kinematic viscosity operator.
-        
+        kinematic viscosity operator, on the vegetated cells only.
+
         Based on the formulation of Nepf (1999)
-        
+
         For all cells, the transition from mix_length = depth to a linear
-        approximation of the mixing length happens at veg_density = depth,
-        which is ad = diameter**2 / depth**2
+        approximation of the mixing length happens at veg_spacing = depth,
+        which is ad = diameter**2 / depth**2. Above ad = 0.01 the mixing
+        length is the stem diameter.
+
+        diffusivity = sqrt(k)*mix_length + ad*U*D, zero in dry cells
         """
-        
-        ad_deltaS = self.veg_d_w**2 / self.depth_w**2
-        
-        mix_length_slope = (self.veg_d_w - self.depth_w) / (0.01 - ad_deltaS)
-        
-        self.mix_length = (mix_length_slope * self.ad_w +
-                          (self.depth_w - mix_length_slope * ad_deltaS))
-        
-        ind = self.veg_s_w > self.depth_w
-        self.mix_length[ind] = self.depth_w[ind]
-        
-        ind = self.ad_w > 0.01        
-        self.mix_length[ind] = self.veg_d_w[ind]
+        h_w = self.work_w
+        velocity_w = self.velocity_w
+        mix_length_w = self.mix_length_w
+        diff_w = self.diffusivity_w
+        mask_w = self.mask_w
+        D_w = self.diameter_w
+        ad_w = self.ad_w
+
+        # Depth limited from below so that dry cells stay finite
+        num.maximum(self.depth_w, self.wet_depth, out=h_w)
+        num.divide(self.qcell_w, h_w, out=velocity_w)
+
+        # mix_length = h + (D - h)*(ad - ad_deltaS)/(0.01 - ad_deltaS)
+        num.divide(D_w, h_w, out=diff_w)
+        num.multiply(diff_w, diff_w, out=diff_w) # ad_deltaS
+        num.subtract(ad_w, diff_w, out=mix_length_w)
+        num.subtract(0.01, diff_w, out=diff_w)
+        num.maximum(diff_w, 1e-12, out=diff_w)
+        num.divide(mix_length_w, diff_w, out=mix_length_w)
+        num.subtract(D_w, h_w, out=diff_w)
+        num.multiply(mix_length_w, diff_w, out=mix_length_w)
+        num.add(mix_length_w, h_w, out=mix_length_w)
+
+        num.greater(self.spacing_w, h_w, out=mask_w)
+        num.copyto(mix_length_w, h_w, where=mask_w)
+        num.greater(ad_w, 0.01, out=mask_w)
+        num.copyto(mix_length_w, D_w, where=mask_w)
+
+        # U*(sqrt_k*mix_length + ad*D)
+        num.multiply(mix_length_w, self.sqrt_k_w, out=diff_w)
+        num.add(diff_w, self.adD_w, out=diff_w)
+        num.multiply(diff_w, velocity_w, out=diff_w)
+        num.multiply(diff_w, self.wet_w, out=diff_w)
+
+        num.put(self.diffusivity_c, self.veg_ind, diff_w)
+
+
+
+    def get_checkpoint_state(self):
+        """
+        Return the state that changes during a run, for
+        Domain.save_checkpoint: the class tables, which a vegetation
+        series updates, and the time of the next refresh
+        """
+        state = {'class_diameter': self.class_diameter,
+                 'class_density': self.class_density,
+                 'class_height': self.class_height,
+                 'active_classes': self.active_classes}
+        if self.veg_series is not None:
+            state['next_refresh'] = self.next_refresh
+        return state
+
+
+
+    def set_checkpoint_state(self, state):
+        """
+        Restore the state from get_checkpoint_state and recompute the
+        coefficients derived from the class tables
+        """
+        self.class_diameter[:] = state['class_diameter']
+        self.class_density[:] = state['class_density']
+        self.class_height[:] = state['class_height']
+        if num.any(state['active_classes'] != self.active_classes):
+            self.set_active_classes(state['active_classes'])
+        else:
+            self.update_class_coefficients(num.arange(self.num_classes))
+            if self.use_lookup_table:
+                self.set_chezy_table(self.table_max_depth, self.table_tolerance)
+        if self.store_quantities:
+            for name, table in [('veg_diameter', self.class_diameter),
+                                ('veg_density', self.class_density),
+                                ('veg_height', self.class_height)]:
+                self.domain.quantities[name].\
+                    set_values(table[self.veg_class], location = 'centroids')
+        if 'next_refresh' in state:
+            self.next_refresh = float(state['next_refresh'])
 
-        # turbulent kinetic energy
-        Cb = 0.001
-        k = ((1 - self.ad_w) * Cb + (self.Cd[self.ind] * self.ad_w)**0.66) * self.velocity**2
-        
-        
-        # total diffusivity
-        self.diffusivity[self.ind] = (num.sqrt(k)**0.5 * self.mix_length +
-                                      self.ad_w * self.velocity * self.veg_d_w)
-                    
-                    
-        self.domain.quantities['diffusivity'].\
-                set_values(self.diffusivity, location = 'centroids')
-            
 
 
     def parallel_safe(self):
@@ -20,6 +20,33 @@ except:
     
 path_to_anuga = anuga.__path__[0]
 
+# shallow_water_domain.py replaces anuga's own Domain. It is the anuga 2.x
+# version, which imports the past and future packages, so check both before
+# overwriting any of anuga's files
+anuga_version = getattr(anuga, '__version__', '0')
+problems = []
+try:
+    if int(anuga_version.split('.')[0]) >= 3:
+        problems.append('anuga %s is installed, these files are for anuga 2.x'
+                        % anuga_version)
+except ValueError:
+    problems.append('Cannot read the installed anuga version (%s)' % anuga_version)
+try:
+    import past.utils, future.utils
+except ImportError:
+    problems.append('The past and future packages are not installed '
+                    '(pip install future)')
+if problems:
+    print('\n')
+    print('#' * 60)
+    print('CANNOT INSTALL THE FILES')
+    for problem in problems:
+        print(problem)
+    print('Nothing was copied, the installed anuga is unchanged.')
+    print('#' * 60)
+    print('\n')
+    sys.exit(1)
+
 # Files to copy
 file1 = 'baptist_operator.py'
 file2 = 'config.py'
@@ -38,9 +65,13 @@ dst2 = os.path.join(path_to_anuga,file2)
 #shutil.copy2(src2, dst2)
 
 src3 = os.path.join(path,file3)
-dst3 = os.path.join(path_to_anuga,'shallow_water',file1)
+dst3 = os.path.join(path_to_anuga,'shallow_water',file3)
+# Keep anuga's own Domain, the first time it is replaced
+if os.path.exists(dst3) and not os.path.exists(dst3 + '.orig'):
+    shutil.copy2(dst3, dst3 + '.orig')
 shutil.copy2(src3, dst3)
 
 # Success message
 print('Success!')
 print('Installed extra codes in appropriate folders')
+print('Replaced %s, the original is kept as %s.orig' % (dst3, dst3))
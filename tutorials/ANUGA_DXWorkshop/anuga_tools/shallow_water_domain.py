@@ -94,6 +94,12 @@ import numpy as num
 import sys
 import os
 import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import dill as pickle
@@ -113,9 +119,95 @@ from anuga.utilities.parallel_abstraction import size, rank, get_processor_name
 from anuga.utilities.parallel_abstraction import finalize, send, receive
 from anuga.utilities.parallel_abstraction import pypar_available, barrier
 
+# Only used in parallel, where anuga itself runs on mpi4py
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
 
 #from pypar import size, rank, send, receive, barrier
 
+def write_npz(filename, arrays):
+    """Save a dict of numpy arrays to filename, through a temporary file
+    so filename only ever holds a complete file.
+    """
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fid:
+        num.savez(fid, **arrays)
+    os.replace(tmp_filename, filename)
+
+
+class Checkpoint_writer(object):
+    """Write checkpoints with write_npz from a background thread, so the
+    solver keeps stepping while files go to a (slow, shared) filesystem.
+
+    write copies the state into one of two buffers and queues it. If both
+    buffers are still waiting to be written, write blocks until one is
+    free, so a slow filesystem holds back the solver rather than memory
+    growing without bound. Errors in the thread are raised by the next
+    write or flush.
+    """
+
+    def __init__(self, number_of_buffers=2):
+
+        self.buffers = [{} for i in range(number_of_buffers)]
+        self.free = queue.Queue()
+        for i in range(number_of_buffers):
+            self.free.put(i)
+        self.pending = queue.Queue()
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+
+        while True:
+            filename, i = self.pending.get()
+            try:
+                if self.error is None:
+                    write_npz(filename, self.buffers[i])
+            except Exception as e:
+                self.error = e
+            finally:
+                self.free.put(i)
+                self.pending.task_done()
+
+    def _check_error(self):
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, filename, arrays):
+        """Snapshot the dict of numpy arrays and write it to filename"""
+
+        self._check_error()
+
+        i = self.free.get()
+        buffer = self.buffers[i]
+        for key in list(buffer):
+            if key not in arrays:
+                del buffer[key]
+        for key, value in arrays.items():
+            value = num.asarray(value)
+            if key in buffer and buffer[key].shape == value.shape and \
+               buffer[key].dtype == value.dtype:
+                buffer[key][...] = value
+            else:
+                buffer[key] = value.copy()
+
+        self.pending.put((filename, i))
+
+    def flush(self):
+        """Wait until all queued checkpoints are written"""
+
+        self.pending.join()
+        self._check_error()
+
+
 class Domain(Generic_Domain):
     """
     This class is a specialization of class Generic_Domain from
@@ -227,6 +319,7 @@ class Domain(Generic_Domain):
         # Operator Data Structures
         #-------------------------------
         self.fractional_step_operators = []
+        self.fractional_step_schedule = {}
         self.kv_operator = None
 
 
@@ -265,6 +358,9 @@ class Domain(Generic_Domain):
         self.checkpoint = False
         self.yieldstep_counter = 0
         self.checkpoint_step = 10
+        self.checkpoint_format = 'npz'
+        self.checkpoint_async = False
+        self.checkpoint_writer = None
 
         #-------------------------------
         # Useful auxiliary quantity
@@ -1061,7 +1157,8 @@ class Domain(Generic_Domain):
 
         return self.store_centroids
 
-    def set_checkpointing(self, checkpoint= True, checkpoint_dir = 'CHECKPOINTS', checkpoint_step=10, checkpoint_time = None):
+    def set_checkpointing(self, checkpoint= True, checkpoint_dir = 'CHECKPOINTS', checkpoint_step=10, checkpoint_time = None,
+                          checkpoint_format = 'npz', checkpoint_async = True):
         """
         Set up checkpointing.
 
@@ -1070,9 +1167,17 @@ class Domain(Generic_Domain):
         @param checkpoint_step: Save checkpoint files after this many yieldsteps
         @param checkpoint_time: If set, over-rides checkpoint_step. save checkpoint files
                         after this amount of walltime
+        @param checkpoint_format: 'npz' (default) saves only the evolving state
+                        in a binary file per processor, see save_checkpoint.
+                        'pickle' pickles the whole domain (legacy)
+        @param checkpoint_async: Default = True. Write npz checkpoints from a
+                        background thread while evolve continues, see
+                        Checkpoint_writer
         """
 
-
+        if checkpoint_format not in ['npz', 'pickle']:
+            msg = "checkpoint_format must be 'npz' or 'pickle', not %s" % checkpoint_format
+            raise Exception(msg)
 
         if checkpoint:
             # create checkpoint directory if necessary
@@ -1081,6 +1186,8 @@ class Domain(Generic_Domain):
 
             assert os.path.exists(checkpoint_dir)
             self.checkpoint_dir = checkpoint_dir
+            self.checkpoint_format = checkpoint_format
+            self.checkpoint_async = checkpoint_async and checkpoint_format == 'npz'
             if checkpoint_time is not None:
                 #import time
                 self.walltime_prev = time.time()
@@ -1093,6 +1200,163 @@ class Domain(Generic_Domain):
         else:
             self.checkpoint = False
 
+    def get_checkpoint_state(self):
+        """Return a dict of numpy arrays holding the state that evolves:
+        time, centroid values of the conserved quantities, volume and flux
+        integrals, step counters and the state of the fractional step
+        operators. Static mesh data is in get_checkpoint_mesh.
+        """
+
+        state = {}
+        state['starttime'] = num.array(self.starttime)
+        state['relative_time'] = num.array(self.relative_time)
+        for name in self.conserved_quantities:
+            state[name] = self.quantities[name].centroid_values
+
+        state['boundary_flux_integral'] = self.boundary_flux_integral.boundary_flux_integral
+        state['fractional_step_volume_integral'] = num.array(self.fractional_step_volume_integral)
+        state['volume_history'] = num.array(self.volume_history, dtype=float)
+
+        # Checkpoints are taken at a yield, before evolve counts it, so a
+        # restart carries on counting from the next yieldstep
+        state['yieldstep_counter'] = num.array(self.yieldstep_counter + 1)
+        state['number_of_steps'] = num.array(self.number_of_steps)
+        state['number_of_first_order_steps'] = num.array(self.number_of_first_order_steps)
+
+        # Operators are identified by their position in fractional_step_operators
+        state['number_of_operators'] = num.array(len(self.fractional_step_operators))
+        for i, operator in enumerate(self.fractional_step_operators):
+            schedule = self.fractional_step_schedule.get(operator)
+            if schedule is not None:
+                state['operator_%d/steps' % i] = num.array(schedule['steps'])
+                state['operator_%d/timestep' % i] = num.array(schedule['timestep'])
+            if hasattr(operator, 'get_checkpoint_state'):
+                for key, value in operator.get_checkpoint_state().items():
+                    state['operator_%d/state/%s' % (i, key)] = num.asarray(value)
+
+        return state
+
+    def get_checkpoint_mesh(self):
+        """Return a dict of numpy arrays describing this (sub)domain's
+        mesh, saved once alongside the checkpoints to check they are
+        restored into the same partition.
+        """
+
+        mesh = {}
+        mesh['centroid_coordinates'] = self.centroid_coordinates
+        mesh['elevation'] = self.quantities['elevation'].centroid_values
+        if hasattr(self, 'tri_l2g'):
+            mesh['tri_l2g'] = num.asarray(self.tri_l2g)
+            mesh['tri_full_flag'] = num.asarray(self.tri_full_flag)
+        return mesh
+
+    def get_checkpoint_filename(self, time=None):
+        """Name of the checkpoint file of this processor at time
+        (default the current time), or of its mesh file if time is 'mesh'.
+        """
+
+        if time is None:
+            time = self.get_time()
+        name = os.path.join(self.checkpoint_dir, self.get_name())
+        return name + '_' + str(time) + '.' + self.checkpoint_format
+
+    def save_checkpoint(self):
+        """Write a checkpoint file for this processor.
+
+        With checkpoint_format 'npz', the mesh file is written once and
+        each checkpoint holds only get_checkpoint_state. Files are written
+        to a temporary name and then renamed, so a checkpoint file is
+        always complete. If checkpoint_async, the state is copied and
+        written in the background; call flush_checkpoints to wait for it.
+        """
+
+        filename = self.get_checkpoint_filename()
+
+        if self.checkpoint_format == 'pickle':
+            pickle.dump(self, open(filename, 'wb'))
+            return filename
+
+        mesh_filename = self.get_checkpoint_filename('mesh')
+        if not os.path.exists(mesh_filename):
+            write_npz(mesh_filename, self.get_checkpoint_mesh())
+
+        if self.checkpoint_async:
+            if self.checkpoint_writer is None:
+                self.checkpoint_writer = Checkpoint_writer()
+            self.checkpoint_writer.write(filename, self.get_checkpoint_state())
+        else:
+            write_npz(filename, self.get_checkpoint_state())
+        return filename
+
+    def flush_checkpoints(self):
+        """Wait until the background writer has written all checkpoints"""
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
+
+    def load_checkpoint(self, filename):
+        """Restore the state saved by save_checkpoint (npz format) into
+        this domain, e.g. a freshly created and distributed domain set up
+        with the same partition, operators and checkpoint_dir.
+        Returns the time of the checkpoint.
+        """
+
+        with num.load(filename) as state:
+            state = dict(state)
+
+        mesh_filename = os.path.join(os.path.dirname(filename),
+                                     self.get_name() + '_mesh.npz')
+        if os.path.exists(mesh_filename):
+            with num.load(mesh_filename) as mesh:
+                if hasattr(self, 'tri_l2g') and 'tri_l2g' in mesh and \
+                   not num.array_equal(mesh['tri_l2g'], self.tri_l2g):
+                    msg = ('Checkpoint %s was saved from a different '
+                           'partition of the mesh' % filename)
+                    raise Exception(msg)
+
+        n = self.number_of_elements
+        for name in self.conserved_quantities:
+            if len(state[name]) != n:
+                msg = ('Checkpoint %s has %d triangles, the domain has %d'
+                       % (filename, len(state[name]), n))
+                raise Exception(msg)
+
+        number_of_operators = int(state['number_of_operators'])
+        if number_of_operators != len(self.fractional_step_operators):
+            msg = ('Checkpoint %s has %d fractional step operators, the '
+                   'domain has %d' % (filename, number_of_operators,
+                                      len(self.fractional_step_operators)))
+            raise Exception(msg)
+
+        self.starttime = float(state['starttime'])
+        self.relative_time = float(state['relative_time'])
+        for name in self.conserved_quantities:
+            self.quantities[name].centroid_values[:] = state[name]
+
+        self.boundary_flux_integral.boundary_flux_integral[:] = state['boundary_flux_integral']
+        self.fractional_step_volume_integral = float(state['fractional_step_volume_integral'])
+        self.volume_history = list(state['volume_history'])
+
+        self.yieldstep_counter = int(state['yieldstep_counter'])
+        self.number_of_steps = int(state['number_of_steps'])
+        self.number_of_first_order_steps = int(state['number_of_first_order_steps'])
+
+        for i, operator in enumerate(self.fractional_step_operators):
+            schedule = self.fractional_step_schedule.get(operator)
+            if schedule is not None:
+                schedule['steps'] = int(state['operator_%d/steps' % i])
+                schedule['timestep'] = float(state['operator_%d/timestep' % i])
+            prefix = 'operator_%d/state/' % i
+            operator_state = dict((key[len(prefix):], value)
+                                  for key, value in state.items()
+                                  if key.startswith(prefix))
+            if operator_state:
+                operator.set_checkpoint_state(operator_state)
+
+        self.distribute_to_vertices_and_edges()
+
+        return self.get_time()
+
     def set_sloped_mannings_function(self, flag=True):
         """Set mannings friction function to use the sloped
         wetted area.
@@ -1346,14 +1610,20 @@ class Domain(Generic_Domain):
 
 
 
-    def set_use_kinematic_viscosity(self, flag=True):
+    def set_use_kinematic_viscosity(self, flag=True, diffusivity='height'):
+        """Turn the kinematic viscosity operator on or off.
+
+        @param diffusivity: Name of the quantity used as diffusivity
+                        (e.g. 'diffusivity' set by Baptist_operator)
+        """
 
         from anuga.operators.kinematic_viscosity_operator import Kinematic_viscosity_operator
 
         if flag :
             # Create Operator if necessary
             if self.kv_operator is None:
-                self.kv_operator = Kinematic_viscosity_operator(self)
+                self.kv_operator = Kinematic_viscosity_operator(self,
+                                                diffusivity=diffusivity)
         else:
             if self.kv_operator is None:
                 return
@@ -1363,6 +1633,58 @@ class Domain(Generic_Domain):
                 self.kv_operator = None
 
 
+    def set_fractional_step_operator_interval(self, operator, nsteps=None, interval=None):
+        """Apply a fractional step operator at a reduced frequency.
+
+        @param operator: An operator in domain.fractional_step_operators
+        @param nsteps: Apply the operator every nsteps timesteps
+        @param interval: Apply the operator once this much model time
+                        (seconds) has elapsed since it was last applied
+
+        The operator is called with domain.timestep set to the time
+        accumulated since its last application, so operators written in
+        terms of get_timestep() (Baptist, Inlet, kinematic viscosity)
+        apply the same total forcing. It is always applied on the step
+        that reaches a yieldstep or finaltime. Calling with nsteps and
+        interval both None restores application every timestep.
+
+        The accumulated time is applied in one step: an Inlet_operator
+        adds (or removes) Q times the interval of water at once, and
+        drag must use an implicit scheme. Operators with
+        scheme='explicit' (e.g. Baptist_operator) are refused, as the
+        explicit drag update overshoots and reverses the flow once the
+        timestep is large.
+        """
+
+        if nsteps is None and interval is None:
+            self.fractional_step_schedule.pop(operator, None)
+            return
+
+        if getattr(operator, 'scheme', None) == 'explicit':
+            msg = ('Operator %s uses the explicit drag scheme, which is '
+                   'unstable when applied at a reduced frequency. Use '
+                   "scheme='semi_implicit'" % operator.__class__.__name__)
+            raise Exception(msg)
+
+        if nsteps is not None and interval is not None:
+            msg = 'Only one of nsteps and interval may be specified'
+            raise Exception(msg)
+
+        if nsteps is not None and int(nsteps) < 1:
+            msg = 'nsteps (%s) should be a positive integer' % nsteps
+            raise Exception(msg)
+
+        if interval is not None and interval < 0.0:
+            msg = 'interval (%s) should be non-negative' % interval
+            raise Exception(msg)
+
+        self.fractional_step_schedule[operator] = {
+            'nsteps': None if nsteps is None else int(nsteps),
+            'interval': None if interval is None else float(interval),
+            'steps': 0,
+            'timestep': 0.0}
+
+
 
 
 
@@ -1603,10 +1925,63 @@ class Domain(Generic_Domain):
                    get_maximum_location(indices=wet_elements)
 
 
-    def get_water_volume(self):
+    def global_sum(self, value):
+        """Sum value (a number or numpy array) over all processors
+
+        Every processor gets the total, from one MPI allreduce. Runs on
+        more than one processor always have mpi4py, which anuga's
+        parallel mode is built on.
+        """
+
+        from anuga import numprocs
+
+        if numprocs == 1:
+            return value
+
+        return MPI.COMM_WORLD.allreduce(value, op=MPI.SUM)
+
+    def global_broadcast(self, value):
+        """Send value from processor 0 to all processors
+
+        Returns the value of processor 0 on every processor, from one MPI
+        broadcast, as in global_sum.
+        """
 
         from anuga import numprocs
 
+        if numprocs == 1:
+            return value
+
+        return MPI.COMM_WORLD.bcast(value, root=0)
+
+    def global_sums(self, *values):
+        """Sum each of values (numbers or numpy arrays) over all processors
+
+        The values are packed into one buffer so a single global_sum
+        (one synchronisation) covers them all. Returns a list of the
+        totals, in the same order and shapes as values.
+        """
+
+        from anuga import numprocs
+
+        if numprocs == 1:
+            return list(values)
+
+        arrays = [num.asarray(value, dtype=num.float64) for value in values]
+        buffer = num.concatenate([array.ravel() for array in arrays])
+        buffer = self.global_sum(buffer)
+
+        totals = []
+        start = 0
+        for value, array in zip(values, arrays):
+            total = buffer[start:start+array.size].reshape(array.shape)
+            start += array.size
+            totals.append(total if isinstance(value, num.ndarray) else total.item())
+        return totals
+
+    def _get_local_water_volume(self):
+        """Volume of water on this processor's full triangles"""
+
         #print self.evolved_called
 
         if not self.evolved_called:
@@ -1628,28 +2003,21 @@ class Domain(Generic_Domain):
             Height = Stage-Elev
             volume = Height.get_integral()
 
-        if numprocs == 1:
-            self.volume_history.append(volume)
-            return volume
+        return volume
 
-        # isolated parallel code
-        from anuga import myid, send, receive, barrier
+    def _get_local_boundary_flux_integral(self):
+        """Boundary flux integral of this processor's triangles"""
 
-        if myid == 0:
-            water_volume = volume
-            for i in range(1,numprocs):
-                remote_volume = receive(i)
-                water_volume = water_volume + remote_volume
-        else:
-            send(volume,0)
+        if not self.compute_fluxes_method=='DE':
+            msg='Boundary flux integral only supported for DE fluxes '+\
+                '(because computation of boundary_flux_sum is only implemented there)'
+            raise_(Exception, msg)
 
-        #barrier()
+        return self.boundary_flux_integral.boundary_flux_integral[0]
 
-        if myid == 0:
-            for i in range(1,numprocs):
-                send(water_volume,i)
-        else:
-            water_volume = receive(0)
+    def get_water_volume(self):
+
+        water_volume = self.global_sum(self._get_local_water_volume())
 
         self.volume_history.append(water_volume)
         return water_volume
@@ -1660,37 +2028,7 @@ class Domain(Generic_Domain):
             Should work in parallel
         """
 
-        from anuga import numprocs
-
-        if not self.compute_fluxes_method=='DE':
-            msg='Boundary flux integral only supported for DE fluxes '+\
-                '(because computation of boundary_flux_sum is only implemented there)'
-            raise_(Exception, msg)
-
-        flux_integral = self.boundary_flux_integral.boundary_flux_integral[0]
-
-        if numprocs == 1:
-            return flux_integral
-
-        # isolate parallel code
-        from anuga import myid, send, receive, barrier
-
-        if myid == 0:
-            for i in range(1,numprocs):
-                remote_flux_integral = receive(i)
-                flux_integral = flux_integral + remote_flux_integral
-        else:
-            send(flux_integral,0)
-
-        #barrier()
-
-        if myid == 0:
-            for i in range(1,numprocs):
-                send(flux_integral,i)
-        else:
-            flux_integral = receive(0)
-
-        return flux_integral
+        return self.global_sum(self._get_local_boundary_flux_integral())
 
     def get_fractional_step_volume_integral(self):
         """
@@ -1700,32 +2038,7 @@ class Domain(Generic_Domain):
             Should work in parallel
         """
 
-        from anuga import numprocs
-
-        flux_integral = self.fractional_step_volume_integral
-
-        if numprocs == 1:
-            return flux_integral
-
-        # isolate parallel code
-        from anuga import myid, send, receive, barrier
-
-        if myid == 0:
-            for i in range(1,numprocs):
-                remote_flux_integral = receive(i)
-                flux_integral = flux_integral + remote_flux_integral
-        else:
-            send(flux_integral,0)
-
-        #barrier()
-
-        if myid == 0:
-            for i in range(1,numprocs):
-                send(flux_integral,i)
-        else:
-            flux_integral = receive(0)
-
-        return flux_integral
+        return self.global_sum(self.fractional_step_volume_integral)
 
     def get_flow_through_cross_section(self, polyline, verbose=False):
         """Get the total flow through an arbitrary poly line.
@@ -2413,6 +2726,59 @@ class Domain(Generic_Domain):
 
 
 
+    def apply_fractional_steps(self):
+        """Apply the fractional step operators, honouring any application
+        interval set with set_fractional_step_operator_interval.
+
+        Called before relative_time is advanced by self.timestep.
+        """
+
+        if not self.fractional_step_schedule:
+            for operator in self.fractional_step_operators:
+                operator()
+            return
+
+        from anuga.config import epsilon
+
+        timestep = self.timestep
+        end_time = self.relative_time + timestep
+
+        # Always bring deferred operators up to date before yielding
+        relative_yieldtime = getattr(self, 'relative_yieldtime', None)
+        relative_finaltime = getattr(self, 'relative_finaltime', None)
+        at_yield = ((relative_yieldtime is not None and
+                     end_time >= relative_yieldtime - epsilon) or
+                    (relative_finaltime is not None and
+                     end_time >= relative_finaltime - epsilon))
+
+        for operator in self.fractional_step_operators:
+            schedule = self.fractional_step_schedule.get(operator)
+            if schedule is None:
+                operator()
+                continue
+
+            schedule['steps'] += 1
+            schedule['timestep'] += timestep
+
+            if not at_yield:
+                if schedule['nsteps'] is not None and \
+                   schedule['steps'] < schedule['nsteps']:
+                    continue
+                if schedule['interval'] is not None and \
+                   schedule['timestep'] < schedule['interval'] - epsilon:
+                    continue
+
+            # Apply with the accumulated timestep
+            self.timestep = schedule['timestep']
+            try:
+                operator()
+            finally:
+                self.timestep = timestep
+
+            schedule['steps'] = 0
+            schedule['timestep'] = 0.0
+
+
     def evolve(self,
                yieldstep=None,
                outputstep=None,
@@ -2475,38 +2841,58 @@ class Domain(Generic_Domain):
             if self.checkpoint:
                 save_checkpoint=False
                 if self.checkpoint_step == 0:
+                    # Processor 0 decides on walltime, for all processors
                     if rank() == 0:
                         if walltime - self.walltime_prev > self.checkpoint_time:
 
                             save_checkpoint = True
-                        for cpu in range(size()):
-                            if cpu != rank():
-                                send(save_checkpoint, cpu)
-                    else:
-                        save_checkpoint = receive(0)
+                    save_checkpoint = self.global_broadcast(save_checkpoint)
 
                 elif self.yieldstep_counter%self.checkpoint_step == 0:
                         save_checkpoint = True
 
                 if save_checkpoint:
-                    pickle_name = os.path.join(self.checkpoint_dir,self.get_name())+'_'+str(self.get_time())+'.pickle'
-                    pickle.dump(self, open(pickle_name, 'wb'))
+                    checkpoint_name = self.save_checkpoint()
 
-                    barrier()
+                    if not self.checkpoint_async:
+                        barrier()
                     self.walltime_prev = time.time()
 
-                    #print 'Stored Checkpoint File '+pickle_name
+                    #print 'Stored Checkpoint File '+checkpoint_name
 
             # Pass control on to outer loop for more specific actions
             yield(t)
 
             self.yieldstep_counter += 1
 
-    def initialise_storage(self):
+        # Make sure the last checkpoints are on disk
+        self.flush_checkpoints()
+
+    def initialise_storage(self, append=False):
         """Create and initialise self.writer object for storing data.
         Also, save x,y and bed elevation
+
+        If append, reopen the existing sww file instead, e.g. after
+        load_checkpoint, and add the next timesteps to the end of it.
         """
 
+        if append:
+            from anuga.config import netcdf_mode_a
+            from anuga.file.sww import Write_sww
+
+            # Append mode skips the header, so make the writer here
+            self.writer = SWW_file(self, mode=netcdf_mode_a)
+            stored = self.quantities_to_be_stored
+            static = [q for q in stored if stored[q] == 1]
+            dynamic = [q for q in stored if stored[q] == 2]
+            if self.store_centroids:
+                static_c = [q+'_c' for q in static]
+                dynamic_c = [q+'_c' for q in dynamic]
+            else:
+                static_c = dynamic_c = []
+            self.writer.writer = Write_sww(static, dynamic, static_c, dynamic_c)
+            return
+
         # Initialise writer
         self.writer = SWW_file(self)
 
@@ -2818,11 +3204,13 @@ class Domain(Generic_Domain):
                 print('Water_volume_statistics only supported for DE algorithm ')
             return
 
-        # Compute the volume
-        Vol=self.get_water_volume()
-        # Compute the boundary flux integral
-        fluxIntegral=self.get_boundary_flux_integral()
-        fracIntegral=self.get_fractional_step_volume_integral()
+        # Compute the volume, boundary flux integral and fractional step
+        # volume integral together, in one global reduction
+        Vol, fluxIntegral, fracIntegral = self.global_sums(
+            self._get_local_water_volume(),
+            self._get_local_boundary_flux_integral(),
+            self.fractional_step_volume_integral)
+        self.volume_history.append(Vol)
 
         if(verbose and myid==0):
             print(' ')
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the Baptist_operator drag update, comparing the numpy
+implementation with the compiled (numba) kernels, exact and tabulated, on a
+~1M cell domain.
+Assumes anuga_tools/install.py has been run.
+Usage: python bench_baptist_kernel.py [--cells 1000000] [--repeat 20]
+"""
+# ------------------------------------------------------------------------------
+# Import necessary modules
+# ------------------------------------------------------------------------------
+from __future__ import division, print_function
+import argparse
+import time
+import numpy as np
+import anuga
+from anuga.operators import baptist_operator
+from anuga.operators.baptist_operator import Baptist_operator
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--cells', type=int, default=1000000,
+                    help='Approximate number of triangles')
+parser.add_argument('--repeat', type=int, default=20,
+                    help='Number of operator calls to time')
+args = parser.parse_args()
+
+# ------------------------------------------------------------------------------
+# Synthetic domain with the six WLAD friction classes
+# ------------------------------------------------------------------------------
+m_array = np.array([0, 0, 0, 120, 200, 200], dtype=float)
+h_array = np.array([0, 0, 0, 0.5, 1.0, 10], dtype=float)
+D_array = np.array([0, 0, 0, 0.01, 0.01, 0.015], dtype=float)
+
+def build_domain(cells, seed=0):
+    """
+    Rectangular cross domain (4 triangles per square) with random topography,
+    momentum and vegetation classes
+    """
+    side = max(int(np.sqrt(cells/4.)), 1)
+    domain = anuga.rectangular_cross_domain(side, side,
+                                            len1=25.*side, len2=25.*side)
+    domain.set_flow_algorithm('DE1')
+    num_cells = len(domain)
+
+    rng = np.random.RandomState(seed)
+    elev = rng.uniform(-1.0, 1.0, num_cells)
+    stage = np.maximum(elev, rng.uniform(-0.5, 1.5, num_cells))
+    domain.set_quantity('elevation', elev, location='centroids')
+    domain.set_quantity('stage', stage, location='centroids')
+    domain.set_quantity('xmomentum', rng.normal(0, 0.3, num_cells),
+                        location='centroids')
+    domain.set_quantity('ymomentum', rng.normal(0, 0.3, num_cells),
+                        location='centroids')
+    domain.timestep = 0.01 # Small enough that repeated explicit calls stay bounded
+    veg_class = rng.randint(0, len(m_array), num_cells)
+    return domain, veg_class
+
+def time_operator(domain, veg_class, use_compiled, repeat,
+                  use_lookup_table=False):
+    """
+    Return seconds per call of the operator
+    """
+    op = Baptist_operator(domain,
+                          veg_diameter=D_array[veg_class],
+                          veg_density=m_array[veg_class],
+                          veg_height=h_array[veg_class],
+                          use_compiled=use_compiled,
+                          use_lookup_table=use_lookup_table)
+    op() # Warm up (and compile the kernel)
+    tic = time.perf_counter()
+    for ii in range(repeat):
+        op()
+    toc = time.perf_counter()
+    domain.fractional_step_operators.remove(op)
+    return (toc - tic)/repeat
+
+# ------------------------------------------------------------------------------
+# Run
+# ------------------------------------------------------------------------------
+domain, veg_class = build_domain(args.cells)
+print('Number of triangles: %d' % len(domain))
+
+t_numpy = time_operator(domain, veg_class, False, args.repeat)
+print('numpy kernel:    %.3f ms/call' % (1000*t_numpy))
+
+if baptist_operator.numba_available:
+    t_numba = time_operator(domain, veg_class, True, args.repeat)
+    print('compiled kernel: %.3f ms/call' % (1000*t_numba))
+    print('speedup:         %.1fx' % (t_numpy/t_numba))
+    t_table = time_operator(domain, veg_class, True, args.repeat, True)
+    print('compiled table:  %.3f ms/call' % (1000*t_table))
+else:
+    print('numba not available, compiled kernel not timed')
@@ -0,0 +1,391 @@
+"""
+Equivalence checks of the rewritten WLAD tools against their original
+implementations, on a synthetic raster, mesh and time series, and of a
+restarted run against an uninterrupted one.
+Each check compares the outputs with numpy.array_equal and prints PASS or
+FAIL. A check that raises, e.g. for lack of gdal, is a FAIL, and the script
+exits with status 1 if any check fails, so it can be used as a regression gate.
+Runs offline, needs anuga, and gdal for the raster2mesh check.
+Usage: python check_equivalence.py [--checks raster2mesh assign_fric_value
+                                              save_outputs time_series restart]
+"""
+# ------------------------------------------------------------------------------
+# Import necessary modules
+# ------------------------------------------------------------------------------
+from __future__ import division, print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import anuga
+from scipy.interpolate import interp1d
+from anuga.utilities.plot_utils import get_centroids
+from anuga.file.netcdf import NetCDFFile
+from anuga.config import netcdf_mode_r
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from WLAD_Model import tools
+
+CHECKS = ['raster2mesh', 'assign_fric_value', 'save_outputs', 'time_series',
+          'restart']
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--checks', nargs='+', default=CHECKS, choices=CHECKS,
+                    help='Checks to run')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed of the synthetic inputs')
+
+# ------------------------------------------------------------------------------
+# Original implementations, as they were before the rewrites
+# ------------------------------------------------------------------------------
+def old_raster2mesh(meshX, meshY, raster_filename):
+    """
+    Raster2Mesh, looping over the points on the whole raster
+    """
+    from osgeo import gdal
+    src = gdal.Open(raster_filename)
+    data_array = np.array(src.GetRasterBand(1).ReadAsArray())
+    # Get geographic info
+    transform = src.GetGeoTransform()
+    xOrigin = transform[0]
+    yOrigin = transform[3]
+    pixelWidth = transform[1]
+    pixelHeight = -transform[5]
+
+    # Loop and grab all values at mesh coords
+    meshVal = np.zeros(len(meshX), dtype=int)
+    for ii in list(range(0, len(meshX))):
+        col = int((meshX[ii] - xOrigin) / pixelWidth)
+        row = int((yOrigin - meshY[ii] ) / pixelHeight)
+        try:
+            meshVal[ii] = data_array[row][col]
+        except IndexError:
+            meshVal[ii] = 0
+    # Return values
+    return meshVal
+
+def old_assign_fric_value(FricVal, n_array=tools.n_array, m_array=tools.m_array,
+                          h_array=tools.h_array, D_array=tools.D_array):
+    """
+    AssignFricValue, looping over the cells
+    """
+    FricVal = FricVal.astype(int)-1 # Subtract 1 assuming map ID's start at 1
+    n = np.zeros_like(FricVal, dtype=float)
+    m = np.zeros_like(FricVal, dtype=float)
+    hv = np.zeros_like(FricVal, dtype=float)
+    D = np.zeros_like(FricVal, dtype=float)
+
+    for ii in list(range(len(FricVal))):
+        n[ii] = n_array[FricVal[ii]]
+        m[ii] = m_array[FricVal[ii]]
+        hv[ii] = h_array[FricVal[ii]]
+        D[ii] = D_array[FricVal[ii]]
+    return n, m, hv, D
+
+def old_save_outputs(swwvals, mydir, friction_ids):
+    """
+    SaveOutputs, from the whole run loaded by get_centroids(). Friction IDs
+    are given by friction_ids(x, y) in place of Raster2Mesh
+    """
+    np.save(mydir+'/data/time.npy', swwvals.time.data, allow_pickle=False)
+    np.save(mydir+'/data/topo.npy', swwvals.elev.data, allow_pickle=False)
+    np.save(mydir+'/data/x.npy', swwvals.x.data, allow_pickle=False)
+    np.save(mydir+'/data/y.npy', swwvals.y.data, allow_pickle=False)
+    np.save(mydir+'/data/xmom.npy', swwvals.xmom, allow_pickle=False)
+    np.save(mydir+'/data/ymom.npy', swwvals.ymom, allow_pickle=False)
+    np.save(mydir+'/data/xvel.npy', swwvals.xvel, allow_pickle=False)
+    np.save(mydir+'/data/yvel.npy', swwvals.yvel, allow_pickle=False)
+    np.save(mydir+'/data/depth.npy', swwvals.height, allow_pickle=False)
+    np.save(mydir+'/data/stage.npy', swwvals.stage, allow_pickle=False)
+    # Extract friction values
+    FricVal = friction_ids(swwvals.x, swwvals.y)
+    n, m, hv, D = old_assign_fric_value(FricVal)
+    a2 = (D*m/(2*9.81)) # Second lumped coefficient
+    chezy = np.zeros_like(swwvals.height)
+    for ii in list(range(len(swwvals.time))):
+        idn = n>0
+        idm = m>0
+        chezy[ii,idn] = (swwvals.height[ii,idn]**(1/6))/n[idn]
+        chezy[ii,idm] = (65.**-2 + a2[idm]*1.68*np.minimum(swwvals.height[ii,idm], hv[idm]))**-0.5 + \
+                        7.8289*np.log(np.maximum(swwvals.height[ii,idm], hv[idm]) / hv[idm])
+    chezy[chezy==0] = 65.
+    np.save(mydir+'/data/chezy.npy', chezy, allow_pickle=False)
+    return
+
+# ------------------------------------------------------------------------------
+# Synthetic inputs
+# ------------------------------------------------------------------------------
+X0, Y0 = 1000., 2000.  # Raster origin (top left corner) [m]
+CELLSIZE = 10.         # Raster pixel size [m]
+NX, NY = 50, 40        # Raster columns and rows
+
+def write_class_raster(filename, ids):
+    """
+    Synthetic GeoTIFF of the given class ids, rows from the top, with
+    origin X0, Y0 and pixels of CELLSIZE
+    """
+    from osgeo import gdal
+    ny, nx = ids.shape
+    driver = gdal.GetDriverByName('GTiff')
+    dst = driver.Create(filename, nx, ny, 1, gdal.GDT_Byte)
+    dst.SetGeoTransform((X0, CELLSIZE, 0.0, Y0, 0.0, -CELLSIZE))
+    dst.GetRasterBand(1).WriteArray(ids)
+    dst.FlushCache()
+    dst = None
+
+def raster_points(rng, n=20000):
+    """
+    Points on the raster, on its pixel edges and past its far edges, where
+    the original Raster2Mesh is defined. Returns x, y
+    """
+    x = [rng.uniform(X0, X0 + NX*CELLSIZE, n),
+         X0 + CELLSIZE*rng.randint(0, NX, n),                  # Pixel edges
+         X0 + NX*CELLSIZE + rng.uniform(0, 5*CELLSIZE, n),    # Past the right
+         rng.uniform(X0, X0 + NX*CELLSIZE, n),
+         X0 - rng.uniform(0, CELLSIZE, n)]                     # Within a pixel
+    y = [rng.uniform(Y0 - NY*CELLSIZE, Y0, n),
+         Y0 - CELLSIZE*rng.randint(0, NY, n),
+         rng.uniform(Y0 - NY*CELLSIZE, Y0, n),
+         Y0 - NY*CELLSIZE - rng.uniform(0, 5*CELLSIZE, n),    # Past the bottom
+         rng.uniform(Y0 - NY*CELLSIZE, Y0, n)]
+    return np.concatenate(x), np.concatenate(y)
+
+def friction_ids(x, y):
+    """
+    Synthetic friction IDs 0-6 of points, standing in for a raster sampled
+    by Raster2Mesh, with 0 (off raster) past its far edges
+    """
+    col = np.floor((np.asarray(x) - X0)/CELLSIZE).astype(int)
+    row = np.floor((Y0 - np.asarray(y))/CELLSIZE).astype(int)
+    ids = 1 + (3*col + 5*row) % 6
+    ids[(col >= NX) | (row >= NY)] = 0
+    return ids
+
+def tidal_domain(workdir, name='tidal'):
+    """
+    Synthetic model over the raster, sloping up from a tidal boundary so
+    that cells wet and dry. The mesh reaches past the far edges of the
+    raster. Returns the domain, storing its output in workdir
+    """
+    domain = anuga.rectangular_cross_domain(30, 20, len1=NX*CELLSIZE + 100.,
+                                            len2=NY*CELLSIZE + 100.,
+                                            origin=(X0, Y0 - NY*CELLSIZE - 100.))
+    domain.set_name(name)
+    domain.set_datadir(workdir)
+    domain.set_store_centroids(True)
+    domain.set_quantity('elevation', lambda x, y: -0.5 + (x - X0)/200.)
+    domain.set_quantity('friction', 0.025)
+    domain.set_quantity('stage', 0.3)
+    Br = anuga.Reflective_boundary(domain)
+    Bt = anuga.Time_boundary(domain, function=lambda t: [0.3 + 0.5*np.sin(t/20.), 0, 0])
+    domain.set_boundary({'left': Bt, 'right': Br, 'top': Br, 'bottom': Br})
+    return domain
+
+def write_sww(workdir, name='tidal'):
+    """
+    Synthetic run of tidal_domain. Returns the .sww filename
+    """
+    domain = tidal_domain(workdir, name)
+    for t in domain.evolve(yieldstep=5., finaltime=200.):
+        pass
+    return os.path.join(workdir, name + '.sww')
+
+def series_times(rng, n=2000):
+    """
+    Gauge-like time series times: 6 minute epoch seconds and a fractional
+    step, both uniform so located by index arithmetic, and irregular gaps
+    located by bisection. Returns a dict of name: times
+    """
+    return {'6 minute': 360.*np.arange(n),
+            'fractional step': 2.5*np.arange(n) + 1.0e5,
+            'irregular': np.cumsum(rng.uniform(0.1, 600., n))}
+
+def query_times(rng, times, n=20000):
+    """
+    Times within the series: the knots, just either side of them, their
+    midpoints and random times
+    """
+    return np.concatenate([times,
+                           np.nextafter(times[1:], -np.inf),
+                           np.nextafter(times[:-1], np.inf),
+                           (times[1:] + times[:-1])/2,
+                           rng.uniform(times[0], times[-1], n)])
+
+# ------------------------------------------------------------------------------
+# Checks, each returns a list of (description, passed)
+# ------------------------------------------------------------------------------
+def check_raster2mesh(workdir, rng):
+    raster = os.path.join(workdir, 'classes.tif')
+    write_class_raster(raster, rng.randint(1, 7, (NY, NX)).astype(np.uint8))
+    x, y = raster_points(rng)
+    old = old_raster2mesh(x, y, raster)
+    results = [('Raster2Mesh', np.array_equal(tools.Raster2Mesh(x, y, raster), old))]
+
+    # Cold then warm cache
+    cache_dir = os.path.join(workdir, 'cache')
+    for state in ['cold', 'warm']:
+        new = tools.Raster2MeshCached(x, y, raster, cache_dir)
+        results.append(('Raster2MeshCached, %s cache' % state,
+                        np.array_equal(new, old)))
+
+    # The original wrapped around for points before the origin, these now get 0
+    before = (np.array([X0 - 2*CELLSIZE, X0 + CELLSIZE]),
+              np.array([Y0 - CELLSIZE, Y0 + 2*CELLSIZE]))
+    results.append(('Raster2Mesh, points before the origin give 0',
+                    np.array_equal(tools.Raster2Mesh(before[0], before[1], raster),
+                                   [0, 0])))
+    return results
+
+def check_assign_fric_value(workdir, rng):
+    # IDs 1-6 and 0 (off raster), which the original sent to the last class,
+    # as friction_nodata_class does in settings.py
+    FricVal = rng.randint(0, len(tools.n_array) + 1, 100000)
+    results = []
+    for dtype in [int, np.uint8, float]:
+        old = old_assign_fric_value(FricVal.astype(dtype))
+        new = tools.AssignFricValue(FricVal.astype(dtype))
+        results.append(('AssignFricValue, %s IDs' % np.dtype(dtype).name,
+                        all(np.array_equal(a, b) for a, b in zip(new, old))))
+    return results
+
+def check_save_outputs(workdir, rng):
+    sww_file = write_sww(workdir)
+    olddir = os.path.join(workdir, 'old')
+    os.makedirs(olddir + '/data')
+    old_save_outputs(get_centroids(sww_file, timeSlices='all'), olddir,
+                     friction_ids)
+
+    def compare(mydir):
+        return all(np.array_equal(np.load(olddir + '/data/%s.npy' % name),
+                                  np.load(mydir + '/data/%s.npy' % name))
+                   for name in ['time', 'topo', 'x', 'y'] + tools.output_names)
+
+    # The friction map is sampled by Raster2MeshCached, checked above
+    Raster2MeshCached = tools.Raster2MeshCached
+    tools.Raster2MeshCached = lambda x, y, *args, **kwargs: friction_ids(x, y)
+    results = []
+    try:
+        # One chunk, then a few timesteps per chunk
+        for chunk_mb in [tools.output_chunk_mb, 0.5]:
+            mydir = os.path.join(workdir, 'chunk_%s' % chunk_mb)
+            os.makedirs(mydir + '/data')
+            tools.SaveOutputs(sww_file, mydir, chunk_mb=chunk_mb, processes=1)
+            results.append(('SaveOutputs, chunk_mb=%s' % chunk_mb, compare(mydir)))
+        # Disjoint time ranges filled in turn, as by SaveOutputsParallel
+        mydir = os.path.join(workdir, 'ranges')
+        os.makedirs(mydir + '/data')
+        nt = tools.CreateOutputFiles(sww_file, mydir)
+        for t0, t1 in reversed(tools.TimeRanges(nt, 3)):
+            tools.SaveOutputSlices(sww_file, mydir, t0, t1, chunk_mb=0.5)
+        results.append(('SaveOutputSlices, 3 time ranges', compare(mydir)))
+    finally:
+        tools.Raster2MeshCached = Raster2MeshCached
+    return results
+
+def check_time_series(workdir, rng):
+    results = []
+    for name, times in sorted(series_times(rng).items()):
+        values = rng.normal(size=len(times))
+        t = query_times(rng, times)
+        for kind in ['linear', 'previous']:
+            new = tools.TimeSeries(times, values, kind=kind)
+            old = interp1d(times, values, kind=kind)
+            expected = old(t)
+            results.append(('TimeSeries, %s %s, arrays' % (name, kind),
+                            np.array_equal(new(t), expected)))
+            # Single times, as called by the boundaries every timestep
+            results.append(('TimeSeries, %s %s, single times' % (name, kind),
+                            np.array_equal([new(float(tt)) for tt in t[::10]],
+                                           expected[::10])))
+            outside = []
+            for tt in [times[0] - 1., times[-1] + 1.]:
+                for f in [new, old]:
+                    try:
+                        f(tt)
+                    except ValueError:
+                        outside.append(True)
+                    else:
+                        outside.append(False)
+            results.append(('TimeSeries, %s %s, times outside raise' % (name, kind),
+                            all(outside)))
+    return results
+
+def run_tidal(workdir, finaltime, restart=False, name='tidal'):
+    """
+    Run tidal_domain to finaltime, storing every other yieldstep and
+    checkpointing every third. If restart, resume from the latest
+    checkpoint in workdir as run_parallel.py does. Returns the .sww filename
+    """
+    domain = tidal_domain(workdir, name)
+    checkpoint_dir = os.path.join(workdir, 'checkpoints')
+    domain.set_checkpointing(checkpoint_dir=checkpoint_dir, checkpoint_step=3)
+    sww_file = os.path.join(workdir, name + '.sww')
+    if restart:
+        restart_time = tools.LatestCheckpoint(checkpoint_dir, 1, name)
+        domain.load_checkpoint(tools.CheckpointFile(checkpoint_dir, name,
+                                                    restart_time))
+        tools.TrimSWW(sww_file, domain.get_relative_time())
+        domain.initialise_storage(append=True)
+    for t in domain.evolve(yieldstep=5., outputstep=10., finaltime=finaltime,
+                           skip_initial_step=restart):
+        pass
+    return sww_file
+
+def check_restart(workdir, rng):
+    if not hasattr(anuga.Domain, 'load_checkpoint'):
+        return [('Restart, needs the Domain of anuga_tools/shallow_water_domain.py '
+                 '(see anuga_tools/install.py)', False)]
+    continuous = os.path.join(workdir, 'continuous')
+    restarted = os.path.join(workdir, 'restarted')
+    os.makedirs(continuous)
+    os.makedirs(restarted)
+    sww_continuous = run_tidal(continuous, 120.)
+    # Cut off after an odd yieldstep, the latest checkpoint is at 45 s, so
+    # the restart resumes between outputs
+    run_tidal(restarted, 50.)
+    sww_restarted = run_tidal(restarted, 120., restart=True)
+
+    def read(sww_file, name):
+        fid = NetCDFFile(sww_file, netcdf_mode_r)
+        try:
+            return np.asarray(fid.variables[name][:])
+        finally:
+            fid.close()
+
+    return [('Restart, output times',
+             np.array_equal(read(sww_continuous, 'time'),
+                            read(sww_restarted, 'time'))),
+             ('Restart, checkpoint times',
+              sorted(os.listdir(os.path.join(continuous, 'checkpoints'))) ==
+              sorted(os.listdir(os.path.join(restarted, 'checkpoints')))),
+             ('Restart, stored stage',
+              np.array_equal(read(sww_continuous, 'stage_c'),
+                             read(sww_restarted, 'stage_c')))]
+
+# ------------------------------------------------------------------------------
+# Run
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix='wlad_equivalence_')
+    failed = 0
+    try:
+        for name in args.checks:
+            rng = np.random.RandomState(args.seed)
+            try:
+                results = globals()['check_' + name](workdir, rng)
+            except Exception as e:
+                # e.g. ImportError without gdal, counted as a failure
+                results = [('%s, raised %s: %s' % (name, type(e).__name__, e),
+                            False)]
+            for description, passed in results:
+                print('%s  %s' % ('PASS' if passed else 'FAIL', description))
+                failed += not passed
+    finally:
+        shutil.rmtree(workdir)
+    if failed:
+        print('%d check(s) failed' % failed)
+    sys.exit(1 if failed else 0)
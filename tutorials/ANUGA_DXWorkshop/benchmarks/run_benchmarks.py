@@ -0,0 +1,392 @@
+"""
+Benchmark suite for the WLAD hot paths on synthetic meshes.
+Builds rectangular and WLAD-like graded meshes with synthetic topography,
+tides and vegetation classes, times each hot path and full evolve steps,
+and writes the results to JSON so that they can be compared across commits.
+Runs offline, assumes anuga_tools/install.py has been run.
+Usage: python run_benchmarks.py [--sizes 10000 100000 1000000]
+                                [--meshes rectangular graded]
+                                [--output results.json] [--compare old.json]
+"""
+# ------------------------------------------------------------------------------
+# Import necessary modules
+# ------------------------------------------------------------------------------
+from __future__ import division, print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import anuga
+from anuga.operators.baptist_operator import Baptist_operator
+
+# Raster2Mesh needs gdal, skipped if not available
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+    from osgeo import gdal
+    from WLAD_Model.tools import Raster2Mesh
+    gdal_available = True
+except ImportError:
+    gdal_available = False
+
+HOT_PATHS = ['baptist', 'compute_fluxes', 'distribute_to_vertices_and_edges',
+             'update_conserved_quantities', 'get_water_volume', 'raster2mesh',
+             'evolve_step']
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--sizes', type=int, nargs='+',
+                    default=[10000, 100000, 1000000],
+                    help='Approximate numbers of triangles')
+parser.add_argument('--meshes', nargs='+', default=['rectangular', 'graded'],
+                    choices=['rectangular', 'graded'], help='Mesh types')
+parser.add_argument('--paths', nargs='+', default=HOT_PATHS, choices=HOT_PATHS,
+                    help='Hot paths to time')
+parser.add_argument('--repeat', type=int, default=10,
+                    help='Number of timed calls per hot path')
+parser.add_argument('--steps', type=int, default=20,
+                    help='Approximate number of internal evolve steps to time')
+parser.add_argument('--output', default=None,
+                    help='JSON results file (default bench_<git hash>.json)')
+parser.add_argument('--compare', default=None,
+                    help='Earlier JSON results file to compare against')
+
+# ------------------------------------------------------------------------------
+# Synthetic WLAD-like delta
+# ------------------------------------------------------------------------------
+L = 30000.         # Domain side [m]
+BAY = 0.3          # Fraction of the domain (y < BAY*L) that is open bay
+TIDE = dict(amplitude=0.25, period=7.2722e-5, offset=0.26) # As GenerateTideCosine
+
+# Per class parameters as in settings.py, classes
+# [ocean, channels, small channels, subtidal, intertidal, supratidal]
+n_array = np.array([0.015, 0.028, 0.005,     0,     0,     0])
+m_array = np.array([    0,     0,     0,   120,   200,   200], dtype=float)
+h_array = np.array([    0,     0,     0,   0.5,   1.0,    10])
+D_array = np.array([    0,     0,     0,  0.01,  0.01, 0.015])
+
+def island_polygons(nx=4, ny=3, fill=0.7):
+    """
+    Rectangular islands on a regular grid in the delta, separated by
+    channels. Returns a list of polygons.
+    """
+    islands = []
+    dx = L/nx
+    dy = (1 - BAY)*L/ny
+    for ii in range(nx):
+        for jj in range(ny):
+            x0 = (ii + 0.5*(1 - fill))*dx
+            y0 = BAY*L + (jj + 0.5*(1 - fill))*dy
+            islands.append([[x0, y0], [x0 + fill*dx, y0],
+                            [x0 + fill*dx, y0 + fill*dy], [x0, y0 + fill*dy]])
+    return islands
+
+def topography(x, y):
+    """
+    Bay deepening offshore, channels at -3 m and islands rising from -0.5 m
+    to 0.8 m with some roughness
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    elev = np.where(y < BAY*L, -5.0 + 2.0*y/(BAY*L), -3.0)
+    for poly in island_polygons():
+        (x0, y0), (x1, y1) = poly[0], poly[2]
+        inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+        rise = (y - y0)/(y1 - y0)
+        bumps = 0.2*np.sin(x/250.)*np.cos(y/310.)
+        elev = np.where(inside, -0.5 + 1.3*rise + bumps, elev)
+    return elev
+
+def vegetation_class(x, y, elev):
+    """
+    Class id 0-5 from position and elevation bands
+    """
+    veg_class = np.digitize(elev, [-2.0, -1.0, 0.1, 0.4]) + 1
+    veg_class[np.asarray(y) < BAY*L] = 0
+    return veg_class.astype(np.uint8)
+
+def rectangular_domain(cells):
+    """
+    Rectangular cross mesh (4 triangles per square) over the delta
+    """
+    side = max(int(np.sqrt(cells/4.)), 1)
+    domain = anuga.rectangular_cross_domain(side, side, len1=L, len2=L)
+    Bout = anuga.Time_boundary(domain, function=tide_function)
+    Br = anuga.Reflective_boundary(domain)
+    domain.set_boundary({'bottom': Bout, 'left': Br, 'right': Br, 'top': Br})
+    return domain
+
+def graded_domain(cells):
+    """
+    Unstructured mesh graded like WLAD: fine channels, islands at 100 times
+    and the bay at 1600 times the channel triangle area
+    """
+    islands = island_polygons()
+    island_area = sum((p[2][0] - p[0][0])*(p[2][1] - p[0][1]) for p in islands)
+    channel_area = (1 - BAY)*L*L - island_area
+    # Triangle gives a mean triangle area of about half the maximum
+    res = 2.0*(channel_area + island_area/100. + BAY*L*L/1600.)/cells
+
+    # Regions must lie inside the bounding polygon, so the bay region is
+    # inset by about one channel triangle
+    e = 2*np.sqrt(res)
+    bounding_polygon = [[0, 0], [L, 0], [L, L], [0, L]]
+    interior_regions = [[[[e, e], [L - e, e], [L - e, BAY*L], [e, BAY*L]],
+                         1600*res]]
+    interior_regions += [[poly, 100*res] for poly in islands]
+    domain = anuga.create_domain_from_regions(bounding_polygon,
+                                    boundary_tags={'bay': [0],
+                                                   'sides': [1, 2, 3]},
+                                    maximum_triangle_area=res,
+                                    interior_regions=interior_regions)
+    Bout = anuga.Time_boundary(domain, function=tide_function)
+    Br = anuga.Reflective_boundary(domain)
+    domain.set_boundary({'bay': Bout, 'sides': Br})
+    return domain
+
+def tide_function(t):
+    return [TIDE['amplitude']*np.cos(t*TIDE['period']) + TIDE['offset'], 0.0, 0.0]
+
+def setup_domain(domain):
+    """
+    Topography, initial water level, friction and vegetation as in
+    run_parallel.py. Returns the vegetation class of each cell.
+    """
+    domain.set_flow_algorithm('DE1')
+    domain.set_minimum_allowed_height(0.005)
+    domain.set_store(False)
+    x = domain.centroid_coordinates[:, 0]
+    y = domain.centroid_coordinates[:, 1]
+    elev = topography(x, y)
+    domain.set_quantity('elevation', elev, location='centroids')
+    domain.set_quantity('stage', np.maximum(elev, TIDE['offset']),
+                        location='centroids')
+    veg_class = vegetation_class(x, y, elev)
+    domain.set_quantity('friction', n_array[veg_class], location='centroids')
+    return veg_class
+
+def write_class_raster(filename, cellsize=25.):
+    """
+    Synthetic GeoTIFF of class ids 1-6 covering the domain, as read by
+    Raster2Mesh
+    """
+    n = int(L/cellsize)
+    xc = (np.arange(n) + 0.5)*cellsize
+    yc = L - (np.arange(n) + 0.5)*cellsize
+    X, Y = np.meshgrid(xc, yc)
+    ids = vegetation_class(X.ravel(), Y.ravel(), topography(X.ravel(), Y.ravel())) + 1
+    driver = gdal.GetDriverByName('GTiff')
+    dst = driver.Create(filename, n, n, 1, gdal.GDT_Byte)
+    dst.SetGeoTransform((0.0, cellsize, 0.0, L, 0.0, -cellsize))
+    dst.GetRasterBand(1).WriteArray(ids.reshape(n, n))
+    dst.FlushCache()
+    dst = None
+
+# ------------------------------------------------------------------------------
+# Timing
+# ------------------------------------------------------------------------------
+def time_calls(function, repeat):
+    """
+    Return mean and min seconds per call, after one warm up call
+    """
+    function()
+    calls = []
+    for ii in range(repeat):
+        tic = time.perf_counter()
+        function()
+        calls.append(time.perf_counter() - tic)
+    return {'mean': float(np.mean(calls)), 'min': float(np.min(calls)),
+            'calls': repeat}
+
+def time_evolve(domain, steps):
+    """
+    Seconds per internal evolve step, including the fractional step
+    operators, over at least steps steps after a short warm up
+    """
+    # Yield rarely so that the timestep is set by the CFL condition
+    warm_up = 0
+    for t in domain.evolve(yieldstep=60.0, duration=60.0):
+        warm_up += domain.number_of_steps
+    duration = steps*60.0/max(warm_up, 1) # Mean timestep of the warm up
+    total = 0
+    tic = time.perf_counter()
+    while total < steps:
+        for t in domain.evolve(yieldstep=duration, duration=duration,
+                               skip_initial_step=True):
+            total += domain.number_of_steps
+    toc = time.perf_counter()
+    return {'mean': (toc - tic)/total, 'min': None, 'calls': total}
+
+def check_volume(domain, volume, tolerance=0.05):
+    """
+    Raise an Exception if the water volume is not finite or has changed by
+    more than the fraction tolerance from volume, i.e. the flow blew up
+    """
+    new_volume = domain.get_water_volume()
+    if not np.isfinite(new_volume) or \
+       abs(new_volume - volume) > tolerance*abs(volume):
+        msg = ('Water volume went from %g to %g m3, evolve timings are not '
+               'valid' % (volume, new_volume))
+        raise Exception(msg)
+
+def build_domain(mesh, cells):
+    """
+    Build one mesh with topography, initial flow and vegetation.
+    Returns the domain and its Baptist operator
+    """
+    if mesh == 'rectangular':
+        domain = rectangular_domain(cells)
+    else:
+        domain = graded_domain(cells)
+    veg_class = setup_domain(domain)
+    op = Baptist_operator(domain, veg_diameter=D_array, veg_density=m_array,
+                          veg_height=h_array, veg_class=veg_class,
+                          scheme='semi_implicit')
+    return domain, op
+
+def benchmark_mesh(mesh, cells, paths, repeat, steps, workdir):
+    """
+    Build one mesh and time the requested hot paths
+    """
+    tic = time.perf_counter()
+    domain, op = build_domain(mesh, cells)
+    mesh_seconds = time.perf_counter() - tic
+    print('%s mesh, %d triangles (%.1f s to build)' % (mesh, len(domain),
+                                                      mesh_seconds))
+
+    domain.timestep = 0.5
+    domain.distribute_to_vertices_and_edges()
+    domain.update_boundary()
+    domain.compute_fluxes()
+
+    timings = {}
+    hot_paths = {'baptist': op,
+                 'compute_fluxes': domain.compute_fluxes,
+                 'distribute_to_vertices_and_edges':
+                     domain.distribute_to_vertices_and_edges,
+                 'update_conserved_quantities':
+                     domain.update_conserved_quantities,
+                 'get_water_volume': domain.get_water_volume}
+    for path in paths:
+        if path in hot_paths:
+            timings[path] = time_calls(hot_paths[path], repeat)
+        elif path == 'raster2mesh':
+            if not gdal_available:
+                print('  gdal not available, raster2mesh not timed')
+                continue
+            raster = os.path.join(workdir, 'classes.tif')
+            if not os.path.exists(raster):
+                write_class_raster(raster)
+            x = domain.centroid_coordinates[:, 0]
+            y = domain.centroid_coordinates[:, 1]
+            timings[path] = time_calls(lambda: Raster2Mesh(x, y, raster), repeat)
+        if path in timings:
+            print('  %-34s %10.3f ms/call' % (path, 1000*timings[path]['mean']))
+
+    if 'evolve_step' in paths:
+        # Repeated calls of the individual paths leave the flow, edge and
+        # timestep state far from a real run, so time evolve on a new domain
+        domain, op = build_domain(mesh, cells)
+        volume = domain.get_water_volume()
+        timings['evolve_step'] = time_evolve(domain, steps)
+        check_volume(domain, volume)
+        print('  %-34s %10.3f ms/step (%d steps)' % ('evolve_step',
+              1000*timings['evolve_step']['mean'], timings['evolve_step']['calls']))
+
+    return {'mesh': mesh, 'target_triangles': cells,
+            'triangles': len(domain), 'mesh_seconds': mesh_seconds,
+            'timings': timings}
+
+# ------------------------------------------------------------------------------
+# Results
+# ------------------------------------------------------------------------------
+def git_revision():
+    """
+    Hash of the checked out commit and whether the tree has local changes
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here)
+        status = subprocess.check_output(['git', 'status', '--porcelain',
+                                          '--untracked-files=no'], cwd=here)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return sha.decode().strip(), bool(status.strip())
+
+def environment():
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    sha, dirty = git_revision()
+    return {'git_hash': sha, 'git_dirty': dirty,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'host': platform.node(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'anuga': getattr(anuga, '__version__', None),
+            'numba': numba_version}
+
+def compare(results, filename):
+    """
+    Print the ratio of the mean times to those in an earlier results file
+    """
+    with open(filename) as f:
+        old = json.load(f)
+    old_runs = {(r['mesh'], r['target_triangles']): r for r in old['results']}
+    print('\nComparison with %s (commit %s)' % (filename, old['git_hash']))
+    print('%-12s %9s %-34s %10s %10s %7s' % ('mesh', 'triangles', 'path',
+                                            'old [ms]', 'new [ms]', 'ratio'))
+    for run in results:
+        old_run = old_runs.get((run['mesh'], run['target_triangles']))
+        if old_run is None:
+            continue
+        for path, timing in run['timings'].items():
+            if path not in old_run['timings']:
+                continue
+            t_old = old_run['timings'][path]['mean']
+            t_new = timing['mean']
+            print('%-12s %9d %-34s %10.3f %10.3f %7.2f' % (run['mesh'],
+                  run['triangles'], path, 1000*t_old, 1000*t_new, t_new/t_old))
+
+# ------------------------------------------------------------------------------
+# Run
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    args = parser.parse_args()
+    info = environment()
+    output = args.output
+    if output is None:
+        output = 'bench_%s.json' % (info['git_hash'] or 'unknown')[:10]
+    output = os.path.abspath(output)
+    if args.compare is not None:
+        args.compare = os.path.abspath(args.compare)
+
+    # Work in a scratch directory so that mesh and raster files are cleaned up
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='wlad_bench_')
+    os.chdir(workdir)
+    try:
+        results = []
+        for mesh in args.meshes:
+            for cells in args.sizes:
+                results.append(benchmark_mesh(mesh, cells, args.paths,
+                                              args.repeat, args.steps, workdir))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    info['settings'] = {'repeat': args.repeat, 'steps': args.steps}
+    info['results'] = results
+    with open(output, 'w') as f:
+        json.dump(info, f, indent=2)
+    print('Results written to %s' % output)
+
+    if args.compare is not None:
+        compare(results, args.compare)